@@ -0,0 +1,571 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import math
+import time
+import random
+import argparse
+import numpy as np
+
+from lib.page import Page, NotAnImageException
+from lib.panel import Panel
+from lib.panel_array import PanelArray
+from lib.segment import Segment, SegmentSet
+
+
+class Benchmark:
+
+	def __init__(self, folder = None, repeat = 1):
+		self.repeat = repeat
+
+		# Benchmark all images in tests/images/$folder/
+		folders = [folder] if folder else []
+		if len(folders) == 0:
+			with os.scandir('tests/images') as it:
+				for d in it:
+					if d.is_dir() and re.match(r'^\d{3}-', d.name):
+						folders.append(d.path)
+
+		self.files = []
+		for f in folders:
+			with os.scandir(f) as it:
+				for entry in it:
+					if entry.is_file() and not entry.name.endswith('.license'):
+						self.files.append(entry.path)
+		self.files.sort()
+
+	def time_pages(self, **page_options):
+		pages = []
+		elapsed = 0
+		for filename in self.files:
+			for _ in range(self.repeat):
+				t1 = time.time()
+				try:
+					page = Page(filename, numbering = 'ltr', **page_options)
+				except NotAnImageException:
+					break
+				elapsed += time.time() - t1
+			else:
+				pages.append(page)
+
+		return pages, elapsed / self.repeat
+
+	@staticmethod
+	def iou(p1, p2):
+		overlap = p1.overlap_area(p2)
+		union = p1.area() + p2.area() - overlap
+		return overlap / union if union else 0
+
+	# Compare panels found on each page with reference ones: ratio of matching panels, and mean IoU of best matches
+	@staticmethod
+	def accuracy(ref_pages, pages):
+		nb_panels = nb_matching = 0
+		ious = []
+		for ref_page, page in zip(ref_pages, pages):
+			ref_panels = list(map(lambda xywh: Panel(None, xywh), ref_page.get_infos()['panels']))
+			panels = list(map(lambda xywh: Panel(None, xywh), page.get_infos()['panels']))
+
+			for ref_panel in ref_panels:
+				nb_panels += 1
+				if ref_panel in panels:
+					nb_matching += 1
+				ious.append(max(map(lambda p: Benchmark.iou(ref_panel, p), panels)) if panels else 0)
+
+		return {
+			'matching': nb_matching / nb_panels if nb_panels else 1,
+			'iou': sum(ious) / len(ious) if ious else 1,
+		}
+
+	def run_resolution(self, scales, sizes):
+		print(f"########## Detection resolution: {len(self.files)} files, {self.repeat} run(s) each ##########")
+
+		ref_pages, ref_elapsed = self.time_pages()
+		print(f"{'full resolution':>20}: {ref_elapsed:6.2f}s")
+
+		variants = [(f"scale {scale}", {'detection_scale': scale}) for scale in scales]
+		variants += [(f"size {size}px", {'detection_size': size}) for size in sizes]
+
+		for name, page_options in variants:
+			pages, elapsed = self.time_pages(**page_options)
+			accuracy = Benchmark.accuracy(ref_pages, pages)
+			print(
+				f"{name:>20}: {elapsed:6.2f}s (x{ref_elapsed / elapsed if elapsed else 0:.2f} speed)",
+				f"- {accuracy['matching']:.0%} matching panels, mean IoU {accuracy['iou']:.3f}"
+			)
+
+	# Former all-pairs Segment.union_all, kept as a reference for results and timings
+	@staticmethod
+	def union_all_reference(segments):
+		unioned_segments = True
+		while unioned_segments:
+			unioned_segments = False
+			dedup_segments = []
+			used = []
+			for i, s1 in enumerate(segments):
+				for s2 in segments[i + 1:]:
+					if s2 in used:
+						continue
+
+					s3 = s1.union(s2)
+					if s3 is not None:
+						unioned_segments = True
+						dedup_segments += [s3]
+						used.append(s1)
+						used.append(s2)
+						break
+
+				if s1 not in used:
+					dedup_segments += [s1]
+
+			segments = dedup_segments
+
+		return dedup_segments
+
+	# Segments looking like LSD's output on a comic page: panel borders (grid) broken into pieces, plus noise
+	@staticmethod
+	def synthetic_segments(nb_segments, size = 2000, seed = 0):
+		rnd = random.Random(seed)
+		segments = []
+		while len(segments) < nb_segments:
+			if rnd.random() < 0.7:
+				# a piece of a horizontal or vertical border, slightly jittered
+				border = rnd.randrange(0, size, size // 8)
+				start = rnd.randrange(0, size - 100)
+				end = start + rnd.randrange(50, 400)
+				jitter = rnd.randint(-2, 2)
+				if rnd.random() < 0.5:
+					segments.append(Segment((start, border), (end, border + jitter)))
+				else:
+					segments.append(Segment((border, start), (border + jitter, end)))
+			else:
+				x, y = rnd.randrange(size), rnd.randrange(size)
+				segments.append(Segment((x, y), (x + rnd.randint(-200, 200), y + rnd.randint(-200, 200))))
+
+		return segments
+
+	def run_union_all(self, sizes):
+		print(f"########## Segment.union_all on synthetic segments, {self.repeat} run(s) each ##########")
+
+		for size in sizes:
+			segments = Benchmark.synthetic_segments(size)
+
+			timings = {}
+			results = {}
+			for name, union_all in [('reference', Benchmark.union_all_reference), ('current', Segment.union_all)]:
+				t1 = time.time()
+				for _ in range(self.repeat):
+					results[name] = union_all(segments)
+				timings[name] = (time.time() - t1) / self.repeat
+
+			identical = list(map(str, results['reference'])) == list(map(str, results['current']))
+			print(
+				f"{size:>6} segments -> {len(results['current']):>5}:",
+				f"reference {timings['reference']:7.3f}s, current {timings['current']:7.3f}s",
+				f"(x{timings['reference'] / timings['current'] if timings['current'] else 0:.1f} speed)",
+				'- identical results' if identical else '- DIFFERENT RESULTS',
+			)
+
+	# Former double loop of Panel._cached_split, kept as a reference for results and timings
+	@staticmethod
+	def nearby_dots_reference(polygon, max_dist_x, max_dist_y, min_hops):
+		nearby_dots = []
+		for i in range(len(polygon) - min_hops):
+			for j in range(i + min_hops, len(polygon)):
+				seg = Segment(polygon[i][0], polygon[j][0])
+				if seg.dist_x() <= max_dist_x and seg.dist_y() <= max_dist_y:
+					nearby_dots.append([i, j])
+
+		return nearby_dots
+
+	# Former subpolygons construction of Panel._cached_split, kept as a reference for results and timings
+	@staticmethod
+	def split_polygon_reference(polygon, i, j):
+		poly1 = np.zeros(shape = (len(polygon) - j + i, 1, 2), dtype = int)
+		poly2 = np.zeros(shape = (j - i, 1, 2), dtype = int)
+
+		x = y = 0
+		for k in range(len(polygon)):
+			if k <= i or k > j:
+				poly1[x][0] = polygon[k]
+				x += 1
+			else:
+				poly2[y][0] = polygon[k]
+				y += 1
+
+		return poly1, poly2
+
+	# Two panels linked by a narrow neck (a split candidate), outlined by about nb_dots jittered dots
+	@staticmethod
+	def synthetic_polygon(nb_dots, width = 2000, height = 1400, seed = 0):
+		rnd = random.Random(seed)
+		g = width // 40
+		n = height // 10
+		corners = [
+			(0, 0), (width // 2 - g, 0), (width // 2 - g, height // 2 - n), (width // 2 + g, height // 2 - n),
+			(width // 2 + g, 0), (width, 0), (width, height), (width // 2 + g, height),
+			(width // 2 + g, height // 2 + n), (width // 2 - g, height // 2 + n), (width // 2 - g, height), (0, height)
+		]
+
+		dots_per_edge = max(1, nb_dots // len(corners))
+		dots = []
+		for k, (x1, y1) in enumerate(corners):
+			x2, y2 = corners[(k + 1) % len(corners)]
+			for d in range(dots_per_edge):
+				jitter = rnd.randint(-2, 2) if d > 0 else 0
+				dots.append(
+					[
+						x1 + (x2 - x1) * d // dots_per_edge + (jitter if x1 == x2 else 0),
+						y1 + (y2 - y1) * d // dots_per_edge + (jitter if y1 == y2 else 0),
+					]
+				)
+
+		return np.array(dots, dtype = np.int32).reshape(-1, 1, 2)
+
+	@staticmethod
+	def synthetic_page(polygon):
+		page = Page.__new__(Page)
+		page.numbering = 'ltr'
+		page.small_panel_ratio = Page.DEFAULT_MIN_PANEL_SIZE_RATIO
+		page.img_size = [int(polygon[:, 0, 0].max()), int(polygon[:, 0, 1].max())]
+		page.segments = [Segment(polygon[k][0], polygon[(k + 1) % len(polygon)][0]) for k in range(len(polygon))]
+		page.segment_set = SegmentSet(page.segments)
+		page.panels = []
+		return page
+
+	def run_split(self, sizes):
+		print(f"########## Panel._cached_split on synthetic polygons, {self.repeat} run(s) each ##########")
+
+		for size in sizes:
+			polygon = Benchmark.synthetic_polygon(size)
+			panel = Panel(Benchmark.synthetic_page(polygon), polygon = polygon)
+			max_dist_x = int(panel.w() / 3)
+			max_dist_y = int(panel.h() / 3)
+
+			timings = {}
+			pairs = {}
+			for name, nearby_dots, split_polygon in [
+				('reference', Benchmark.nearby_dots_reference, Benchmark.split_polygon_reference),
+				('current', Panel.nearby_dots, Panel.split_polygon),
+			]:
+				t1 = time.time()
+				for _ in range(self.repeat):
+					pairs[name] = nearby_dots(polygon, max_dist_x, max_dist_y, 3)
+					for i, j in pairs[name]:
+						split_polygon(polygon, i, j)
+				timings[name] = (time.time() - t1) / self.repeat
+
+			# compare subpolygons one pair at a time, keeping them all would not fit in memory for big polygons
+			identical = pairs['reference'] == pairs['current'] and all(
+				all(
+					np.array_equal(p1, p2) for p1, p2 in
+					zip(Benchmark.split_polygon_reference(polygon, i, j), Panel.split_polygon(polygon, i, j))
+				) for i, j in pairs['current']
+			)
+
+			t1 = time.time()
+			for _ in range(self.repeat):
+				panel._cached_split()
+			split_time = (time.time() - t1) / self.repeat
+
+			print(
+				f"{len(polygon):>6} dots, {len(pairs['current']):>7} nearby pairs:",
+				f"reference {timings['reference']:7.3f}s, current {timings['current']:7.3f}s",
+				f"(x{timings['reference'] / timings['current'] if timings['current'] else 0:.1f} speed)",
+				'- identical results' if identical else '- DIFFERENT RESULTS',
+				f"- whole split {split_time:.3f}s",
+			)
+
+	# Former Page.group_big_panels, kept as a reference for results and timings
+	@staticmethod
+	def group_big_panels_reference(page):
+		grouped = True
+		while grouped:
+			grouped = False
+			for i, p1 in enumerate(page.panels):
+				for p2 in page.panels[i + 1:]:
+					p3 = p1.group_with(p2)
+
+					other_panels = [p for p in page.panels if p not in [p1, p2]]
+					if p3.bumps_into(other_panels):
+						continue
+
+					# are there big segments in this panel?
+					segments = []
+					for s in page.segments:
+						if p3.contains_segment(s) and s.dist() > p3.diagonal().dist() / 5:
+							if s not in segments:
+								segments.append(s)
+
+					if len(segments) > 0:  # maybe allow a small number of big segments here?
+						continue
+
+					page.panels.append(p3)
+					page.panels.remove(p1)
+					page.panels.remove(p2)
+					grouped = True
+					break
+
+				if grouped:
+					break
+
+	# A page with a grid of nb_panels panels separated by gutter segments, and some noise segments:
+	# on every third row, gutters between columns 0 and 1, 2 and 3... are missing, these pairs of panels
+	# are halves of bigger panels, that group_big_panels should group
+	@staticmethod
+	def synthetic_panels_page(nb_panels, size = 2000, seed = 0):
+		rnd = random.Random(seed)
+		cols = max(1, int(math.sqrt(nb_panels)))
+		rows = max(1, math.ceil(nb_panels / cols))
+		w, h = size // cols, size // rows
+
+		groupable = lambda r, c: r % 3 == 0 and c % 2 == 1 and r * cols + c < nb_panels
+		pairs = [
+			[(c - 1) * w, r * h, (c + 1) * w, (r + 1) * h] for r in range(rows) for c in range(cols) if groupable(r, c)
+		]
+
+		# no noise within pairs of panels to be grouped
+		pairs = np.array(pairs, dtype = np.int64).reshape(-1, 4)
+		segments = Benchmark.synthetic_segments(100, size, seed)
+		segments = [s for s in segments if not PanelArray.boxes_overlap(pairs, s.to_xyrb()).any()]
+		for r in range(1, rows):
+			segments.append(Segment((0, r * h), (size, r * h)))
+		for r in range(rows):
+			for c in range(1, cols):
+				if not groupable(r, c):
+					segments.append(Segment((c * w, r * h), (c * w, (r + 1) * h)))
+
+		page = Page.__new__(Page)
+		page.url = None
+		page.name = None
+		page.filename = 'synthetic'
+		page.license = None
+		page.processing_time = None
+		page.numbering = 'ltr'
+		page.small_panel_ratio = Page.DEFAULT_MIN_PANEL_SIZE_RATIO
+		page.img_size = [size, size]
+		page.segments = segments
+		page.segment_set = SegmentSet(segments)
+		page.panels = [
+			Panel(page, [(k % cols) * w + 5, (k // cols) * h + 5, w - rnd.randint(10, 20), h - rnd.randint(10, 20)])
+			for k in range(nb_panels)
+		]
+		return page
+
+	def run_group_big_panels(self, sizes):
+		print(f"########## Page.group_big_panels on synthetic pages, {self.repeat} run(s) each ##########")
+
+		for size in sizes:
+			timings = {}
+			results = {}
+			for name, group_big_panels in [
+				('reference', Benchmark.group_big_panels_reference),
+				('current', Page.group_big_panels),
+			]:
+				timings[name] = 0
+				for _ in range(self.repeat):
+					page = Benchmark.synthetic_panels_page(size)
+					t1 = time.time()
+					group_big_panels(page)
+					timings[name] += (time.time() - t1) / self.repeat
+				results[name] = [p.to_xywh() for p in page.panels]
+
+			nb_groupings = size - len(results['current'])  # each grouping replaces two panels with one
+			print(
+				f"{size:>6} panels -> {len(results['current']):>5} ({nb_groupings:>3} groupings):",
+				f"reference {timings['reference']:7.3f}s, current {timings['current']:7.3f}s",
+				f"(x{timings['reference'] / timings['current'] if timings['current'] else 0:.1f} speed)",
+				'- identical results' if results['reference'] == results['current'] else '- DIFFERENT RESULTS',
+			)
+
+	# Former Page.deoverlap_panels, kept as a reference for results and timings
+	@staticmethod
+	def deoverlap_panels_reference(page):
+		for p1 in page.panels:
+			for p2 in page.panels:
+				if p1 == p2:
+					continue
+
+				opanel = p1.overlap_panel(p2)
+				if not opanel:
+					continue
+
+				if opanel.w() < opanel.h() and p1.r == opanel.r:
+					p1.r = opanel.x
+					p2.x = opanel.r
+					continue
+
+				if opanel.w() > opanel.h() and p1.b == opanel.b:
+					p1.b = opanel.y
+					p2.y = opanel.b
+					continue
+
+	# Former Page.merge_panels (and Panel.merge), kept as a reference for results and timings
+	@staticmethod
+	def merge_panels_reference(page):
+
+		def merge(p1, p2):
+			possible_panels = [p1]
+
+			if p2.x < p1.x:
+				possible_panels.append(Panel.from_xyrb(p1.page, p2.x, p1.y, p1.r, p1.b))
+
+			if p2.r > p1.r:
+				for pp in possible_panels.copy():
+					possible_panels.append(Panel.from_xyrb(p1.page, pp.x, pp.y, p2.r, pp.b))
+
+			if p2.y < p1.y:
+				for pp in possible_panels.copy():
+					possible_panels.append(Panel.from_xyrb(p1.page, pp.x, p2.y, pp.r, pp.b))
+
+			if p2.b > p1.b:
+				for pp in possible_panels.copy():
+					possible_panels.append(Panel.from_xyrb(p1.page, pp.x, pp.y, pp.r, p2.b))
+
+			other_panels = [p for p in p1.page.panels if p not in [p1, p2]]
+			possible_panels = list(
+				filter(lambda p: not any(o != p and p.overlaps(o) for o in other_panels), possible_panels)
+			)
+
+			return max(possible_panels, key = lambda p: p.area()) if len(possible_panels) > 0 else p1
+
+		panels_to_remove = []
+		for i, p1 in enumerate(page.panels):
+			for j, p2 in enumerate(page.panels[i + 1:]):
+				if p1.contains(p2):
+					panels_to_remove.append(p2)
+					p1 = merge(p1, p2)
+				elif p2.contains(p1):
+					panels_to_remove.append(p1)
+					p2 = merge(p2, p1)
+
+		for p in set(panels_to_remove):
+			page.panels.remove(p)
+
+	# A page with a grid of panels, broken into nb_fragments slightly overlapping fragments (as splits may give)
+	@staticmethod
+	def synthetic_fragments_page(nb_fragments, size = 2000, seed = 0):
+		rnd = random.Random(seed)
+		page = Benchmark.synthetic_panels_page(0, size, seed)
+		nb_panels = max(1, nb_fragments // 4)
+		cols = max(1, int(math.sqrt(nb_panels)))
+		rows = math.ceil(nb_panels / cols)
+		w, h = size // cols, size // rows
+
+		for k in range(nb_fragments):
+			col, row = k % nb_panels % cols, k % nb_panels // cols
+			x = col * w + rnd.randint(0, w // 2)
+			y = row * h + rnd.randint(0, h // 2)
+			page.panels.append(Panel(page, [x, y, rnd.randint(w // 4, w // 2 + 5), rnd.randint(h // 4, h // 2 + 5)]))
+
+		return page
+
+	def run_deoverlap_merge(self, sizes):
+		print(f"########## Page.deoverlap_panels and merge_panels on synthetic pages, {self.repeat} run(s) each ##########")
+
+		for size in sizes:
+			for stage, reference in [
+				('deoverlap_panels', Benchmark.deoverlap_panels_reference),
+				('merge_panels', Benchmark.merge_panels_reference),
+			]:
+				timings = {}
+				results = {}
+				for name, run in [('reference', reference), ('current', getattr(Page, stage))]:
+					timings[name] = 0
+					for _ in range(self.repeat):
+						page = Benchmark.synthetic_fragments_page(size)
+						t1 = time.time()
+						run(page)
+						timings[name] += (time.time() - t1) / self.repeat
+					results[name] = [p.to_xywh() for p in page.panels]
+
+				print(
+					f"{stage:>16}, {size:>5} fragments -> {len(results['current']):>5}:",
+					f"reference {timings['reference']:7.3f}s, current {timings['current']:7.3f}s",
+					f"(x{timings['reference'] / timings['current'] if timings['current'] else 0:.1f} speed)",
+					'- identical results' if results['reference'] == results['current'] else '- DIFFERENT RESULTS',
+				)
+
+
+parser = argparse.ArgumentParser(description = 'Kumiko Benchmark')
+
+parser.add_argument(
+	'action',
+	help = "What to benchmark",
+	choices = ['resolution', 'union_all', 'split', 'group_big_panels', 'deoverlap_merge']
+)
+
+parser.add_argument(
+	'-f',
+	'--folder',
+	nargs = 1,
+	help = 'A folder of images to run the benchmark on (default is all tests/images/ folders)',
+)
+
+parser.add_argument('-r', '--repeat', nargs = 1, type = int, help = 'Number of runs to average timings on')
+
+parser.add_argument(
+	'--scales',
+	nargs = '+',
+	type = float,
+	default = [0.75, 0.5, 0.25],
+	help = 'Scale factors to compare full resolution detection with'
+)
+
+parser.add_argument(
+	'--sizes',
+	nargs = '+',
+	type = int,
+	default = [1000, 600],
+	help = 'Longest edge sizes (in pixels) to compare full resolution detection with'
+)
+
+parser.add_argument(
+	'--segments',
+	nargs = '+',
+	type = int,
+	default = [100, 200, 500, 1000],
+	help = 'Numbers of synthetic segments to run union_all on'
+)
+
+parser.add_argument(
+	'--polygons',
+	nargs = '+',
+	type = int,
+	default = [16, 64, 256, 512],
+	help = 'Numbers of dots of synthetic polygons to split'
+)
+
+parser.add_argument(
+	'--panels',
+	nargs = '+',
+	type = int,
+	default = [10, 20, 40, 80],
+	help = 'Numbers of panels of synthetic pages to group big panels on'
+)
+
+parser.add_argument(
+	'--fragments',
+	nargs = '+',
+	type = int,
+	default = [20, 50, 100, 200],
+	help = 'Numbers of panel fragments of synthetic pages to deoverlap and merge'
+)
+
+args = parser.parse_args()
+
+benchmark = Benchmark(
+	folder = args.folder[0] if args.folder else None,
+	repeat = args.repeat[0] if args.repeat else 1,
+)
+
+if args.action == 'resolution':
+	benchmark.run_resolution(args.scales, args.sizes)
+elif args.action == 'union_all':
+	benchmark.run_union_all(args.segments)
+elif args.action == 'split':
+	benchmark.run_split(args.polygons)
+elif args.action == 'group_big_panels':
+	benchmark.run_group_big_panels(args.panels)
+elif args.action == 'deoverlap_merge':
+	benchmark.run_deoverlap_merge(args.fragments)
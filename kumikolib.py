@@ -1,15 +1,59 @@
 import os
 import sys
+import itertools
+import collections
 import tempfile
 import cv2 as cv
 import numpy as np
-import requests
-import subprocess
-from urllib.parse import urlparse
+from concurrent import futures
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 from lib.page import Page, NotAnImageException
+from lib.cache import Cache
+from lib.archive import Archive
+from lib.download import Downloader
+from lib.panels_export import PanelsExport
 from lib.debug import Debug
 
+try:
+	import resource
+except ImportError:  # not available on Windows
+	resource = None
+
+
+def init_worker():
+	# pages are already spread over processes, keep OpenCV from spawning its own threads in each of them
+	cv.setNumThreads(1)
+
+
+def _parse_page(filename, page_options, stream = False, source = None):
+	page = Page(filename, **(source or {}), **page_options)
+	return Kumiko.compact_page(page, page_options) if stream else page
+
+
+# Long-running worker processes, e.g. server.py's ones
+
+_downloader = None
+
+
+def warm_up_worker():
+	# first page processed in a process is slower (OpenCV initializations), process a small blank one beforehand
+	blank_page = cv.imencode('.png', np.full((100, 100), 255, dtype = np.uint8))[1].tobytes()
+	Page('warm-up', numbering = 'ltr', file_bytes = blank_page)
+	return os.getpid()
+
+
+# Infos of the image at given URL, downloaded on the worker's own pooled session,
+# or of the image with given file name and contents
+def url_page_infos(url, page_options, file_bytes = None):
+	global _downloader
+	if file_bytes is None:
+		if _downloader is None:
+			_downloader = Downloader()
+		file_bytes = _downloader.fetch(url)
+
+	return Page(url, file_bytes = file_bytes, **page_options).get_infos()
+
 
 class Kumiko:
 
@@ -27,46 +71,96 @@ class Kumiko:
 
 		self.panel_expansion = options.get('panel_expansion', True)
 
+		# detect panels on downscaled images: longest edge in pixels, and/or scale factor
+		self.options['detection_size'] = options.get('detection_size', None)
+		self.options['detection_scale'] = options.get('detection_scale', None)
+
+		# number of worker processes for parse_images (0 = one per CPU core)
+		self.options['jobs'] = options.get('jobs', 1)
+		if self.options['jobs'] == 0:
+			self.options['jobs'] = os.cpu_count() or 1
+		if self.options['debug'] and self.options['jobs'] > 1:
+			print('Debug mode processes pages one at a time, ignoring jobs option', file = sys.stderr)
+			self.options['jobs'] = 1
+
+		# resolution PDF pages are rendered at, in dots per inch
+		self.options['pdf_dpi'] = options.get('pdf_dpi', None)
+
+		# streaming mode: pages' pixel buffers and intermediate results are released as soon as their infos are produced
+		self.options['stream'] = options.get('stream', False)
+
+		# on-disk cache of pages' infos, disabled when debugging as steps need to be computed
+		self.cache = None
+		if options.get('cache') and not self.options['debug']:
+			self.cache = Cache(options.get('cache_dir'), options.get('cache_max_size'))
+
+		# called with each page as soon as it is parsed, in pages order
+		self.on_page = options.get('on_page', None)
+
+		# panels export running along detection, see start_panels_export()
+		self.panels_export = None
+
+		# folder pages' images are written to, for pages that are not image files (see save_page_images)
+		self.page_images_dir = None
+
 		self.page_list = []
 
+	# Parse images at given URLs, as soon as each one is downloaded, in memory
 	def parse_url_list(self, urls):
 		if self.options['progress']:
 			print(len(urls), 'files to download', file = sys.stderr)
 
-		self.temp_folder = tempfile.TemporaryDirectory()
-
-		i = 0
 		nbdigits = len(str(len(urls)))
-		for url in urls:
-			filename = 'img' + ('0' * nbdigits + str(i))[-nbdigits:]
+		filenames = list(map(lambda i: 'img' + str(i).zfill(nbdigits), range(len(urls))))
+		files_bytes = Downloader().download_all(urls)
+		self.parse_files(
+			filenames, urls, sources = map(lambda b: None if b is None else {'file_bytes': b}, files_bytes)
+		)
 
-			if self.options['progress']:
-				print('\t', url, (' -> ' + filename) if urls else '', file = sys.stderr)
+	# Parse pages of a PDF file, rendered in memory (in worker processes with the jobs option)
+	def parse_pdf_file(self, pdf_filename):
+		try:
+			from lib.pdf import PdfPage
+		except ImportError:
+			print("Please `pip install PyMuPDF` if you give PDF --input files to Kumiko", file = sys.stderr)
+			sys.exit(1)
 
-			i += 1
-			parts = urlparse(url)
-			if not parts.netloc or not parts.path:
-				continue
+		pdf_pages = PdfPage.pages(pdf_filename, self.options['pdf_dpi'])
 
-			r = requests.get(url, timeout = 5)
-			with open(os.path.join(self.temp_folder.name, filename), 'wb') as f:
-				f.write(r.content)
+		nbdigits = len(str(len(pdf_pages)))
+		filenames = list(map(lambda p: os.path.join(pdf_filename, f"page-{p.number + 1:0{nbdigits}}"), pdf_pages))
+		self.rendered_pdf_pages = []
+		self.parse_files(filenames, sources = map(self.pdf_page_source, filenames, pdf_pages))
 
-		self.parse_dir(self.temp_folder.name, urls = urls)
+		nb_rendered = len(self.rendered_pdf_pages)
+		print(f"PDF pages: {len(pdf_pages) - nb_rendered} embedded images, {nb_rendered} rendered", file = sys.stderr)
+		if self.options['progress'] and nb_rendered > 0:
+			print("Rendered PDF pages:", ', '.join(map(os.path.basename, self.rendered_pdf_pages)), file = sys.stderr)
 
-	def parse_pdf_file(self, pdf_filename):
-		try:
-			subprocess.run(args = ['pdftoppm', '--help'], check = True, capture_output = True)
-		except FileNotFoundError:
-			print("Please `apt install pdftoppm` if you give PDF --input files to Kumiko", file = sys.stderr)
-			sys.exit(1)
+	# Pages that are one JPEG image are read from the PDF file as is, others are rendered
+	def pdf_page_source(self, filename, pdf_page):
+		image = pdf_page.embedded_image()
+		if image is not None:
+			return {'file_bytes': image}
 
-		self.temp_folder = tempfile.mkdtemp(prefix = "kumiko-pdf-pages-")
+		self.rendered_pdf_pages.append(filename)
+		return {'pdf_page': pdf_page}
 
-		print(f"Using pdftoppm to extract jpeg files from pdf to {self.temp_folder}", file = sys.stderr)
-		subprocess.run(args = ['pdftoppm', '-jpeg', pdf_filename, f"{self.temp_folder}/"], check = True)
+	# Parse images of a CBZ or CBR archive, in natural order, without extracting them
+	def parse_archive(self, archive_filename):
+		try:
+			archive = Archive(archive_filename)
+		except ImportError:
+			print("Please `pip install rarfile` if you give CBR --input files to Kumiko", file = sys.stderr)
+			sys.exit(1)
+		except ValueError as e:
+			print(f"\n[ERROR] {e}\n", file = sys.stderr)
+			sys.exit(1)
 
-		self.parse_dir(self.temp_folder)
+		# pages are named by their path in the archive, e.g. chapters' pages ch1/001.jpg and ch2/001.jpg
+		filenames = list(map(lambda entry: os.path.join(archive_filename, entry), archive.entries))
+		sources = map(lambda b: {'file_bytes': b}, archive.read_entries())
+		self.parse_files(filenames, sources = sources, names = archive.entries)
 
 	def parse_dir(self, directory, urls = None):
 		filenames = []
@@ -75,36 +169,190 @@ class Kumiko:
 		self.parse_images(filenames, urls)
 
 	def parse_images(self, filenames, urls = None):
+		self.parse_files(sorted(filenames), urls)
+
+	# Parse given files in order, read from disk, or from given sources (an iterable in the same order as filenames)
+	# of file contents ({'file_bytes': bytes}) or PDF pages ({'pdf_page': PdfPage}), or None for unavailable files.
+	# Pages may be given names, instead of their files' basenames.
+	def parse_files(self, filenames, urls = None, sources = None, names = None):
 		if self.options['progress']:
 			print(len(filenames), 'files to cut panels for', file = sys.stderr)
 
-		i = -1
-		for filename in sorted(filenames):
-			i += 1
+		if sources is None:
+			sources = itertools.repeat({})
+
+		if self.options['jobs'] > 1:
+			self.parse_files_parallel(filenames, urls, sources, names)
+			return
+
+		for i, (filename, source) in enumerate(zip(filenames, sources)):
+			if source is None:
+				continue
+
 			if self.options['progress']:
 				print("\t", urls[i] if urls else filename, file = sys.stderr)
 
 			try:
-				self.parse_image(filename, url = urls[i] if urls else None)
+				self.parse_image(
+					filename, url = urls[i] if urls else None, source = source, name = names[i] if names else None
+				)
 			except NotAnImageException:
 				if not filename.endswith(".license"):
 					print(f"\n[ERROR] Not an image, will be ignored: {filename}\n", file = sys.stderr)
 
-	def parse_image(self, filename, url = None):
-		self.page_list.append(
-			Page(
-				filename,
-				numbering = "rtl" if self.options['rtl'] else "ltr",
-				url = url,
-				min_panel_size_ratio = self.options['min_panel_size_ratio'],
-				panel_expansion = self.panel_expansion,
-			)
+	def parse_files_parallel(self, filenames, urls, sources, names):
+		jobs = self.options['jobs']
+		items = enumerate(zip(filenames, sources))
+
+		# pages are collected in submission order, so that page_list stays sorted, each one as soon as it is done,
+		# and only a few of them are submitted ahead, not to hold all files in memory.
+		# Sources are read by another thread meanwhile, as getting them may take time too (downloads, decompression).
+		with ProcessPoolExecutor(max_workers = jobs, initializer = init_worker) as executor:
+			with ThreadPoolExecutor(max_workers = 1) as sources_reader:
+				next_item = sources_reader.submit(next, items, None)
+				pending = collections.deque()
+				while next_item or len(pending) > 0:
+					window_full = len(pending) > 2 * jobs
+					if len(pending) > 0 and next_item and not window_full and not Kumiko.is_done(pending[0][2]):
+						futures.wait([next_item, pending[0][2]], return_when = futures.FIRST_COMPLETED)
+
+					if len(pending) > 0 and (not next_item or window_full or Kumiko.is_done(pending[0][2])):
+						self.collect_page(filenames, urls, *pending.popleft())
+						continue
+
+					item = next_item.result()
+					if item is None:
+						next_item = None
+						continue
+					next_item = sources_reader.submit(next, items, None)
+
+					i, (filename, source) = item
+					if source is None:
+						continue
+
+					url = urls[i] if urls else None
+					page_options = self.page_options(url = url, name = names[i] if names else None)
+					cache_key, page = self.cached_page(filename, page_options, source)
+					if page is None:
+						page = executor.submit(_parse_page, filename, page_options, self.options['stream'], source)
+					pending.append((i, cache_key, page))
+
+	@staticmethod
+	def is_done(page):
+		return isinstance(page, Page) or page.done()
+
+	def collect_page(self, filenames, urls, i, cache_key, page):
+		if self.options['progress']:
+			print("\t", urls[i] if urls else filenames[i], file = sys.stderr)
+
+		if isinstance(page, Page):
+			self.add_page(page)
+			return
+
+		try:
+			page = page.result()
+		except NotAnImageException:
+			if not filenames[i].endswith(".license"):
+				print(f"\n[ERROR] Not an image, will be ignored: {filenames[i]}\n", file = sys.stderr)
+			return
+
+		self.cache_page(cache_key, page)
+		self.add_page(page)
+
+	def page_options(self, url = None, name = None):
+		return {
+			'numbering': "rtl" if self.options['rtl'] else "ltr",
+			'url': url,
+			'name': name,
+			'min_panel_size_ratio': self.options['min_panel_size_ratio'],
+			'panel_expansion': self.panel_expansion,
+			'detection_size': self.options['detection_size'],
+			'detection_scale': self.options['detection_scale'],
+		}
+
+	# Returns the cache key for given image file (or source, see parse_files), and its page if it was found in cache
+	def cached_page(self, filename, page_options, source = None):
+		if self.cache is None:
+			return None, None
+
+		source = source or {}
+		contents = source.get('file_bytes')
+		if source.get('pdf_page') is not None:
+			contents = source['pdf_page'].cache_key()
+		elif contents is None:
+			try:
+				with open(filename, 'rb') as fh:
+					contents = fh.read()
+			except OSError:
+				return None, None
+
+		cache_key = Cache.key(contents, Page.cache_options(**page_options), Page.ALGORITHM_VERSION)
+		infos = self.cache.get(cache_key)
+		if infos is None:
+			return cache_key, None
+
+		return cache_key, Page.from_infos(filename, infos, **source, **page_options)
+
+	def cache_page(self, cache_key, page):
+		if self.cache is None or cache_key is None:
+			return
+
+		self.cache.set(cache_key, page.get_infos())
+
+	# Same page, rebuilt from its infos: panels only, without pixel buffers nor intermediate results
+	@staticmethod
+	def compact_page(page, page_options):
+		return Page.from_infos(
+			page.filename, page.get_infos(), file_bytes = page.file_bytes, pdf_page = page.pdf_page, **page_options
 		)
 
+	def parse_image(self, filename, url = None, source = None, name = None):
+		page_options = self.page_options(url = url, name = name)
+
+		cache_key, page = self.cached_page(filename, page_options, source)
+		if page is None:
+			page = Page(filename, **(source or {}), **page_options)
+			self.cache_page(cache_key, page)
+			if self.options['stream']:
+				page = Kumiko.compact_page(page, page_options)
+
+		self.add_page(page)
+
+	def add_page(self, page):
+		self.page_list.append(page)
+		if self.panels_export:
+			self.panels_export.add(page)
+		if self.on_page:
+			self.on_page(page)
+		if self.page_images_dir:
+			self.save_page_image(page)
+
+		if self.options['stream']:
+			page.file_bytes = None  # once panels export has them
+
 	def get_infos(self):
 		return list(map(lambda p: p.get_infos(), self.page_list))
 
-	def save_panels(self, output_base_path = 'auto', output_format = "jpg"):
+	# Write images of next parsed pages to given folder, as they are parsed, e.g. PDF pages for the HTML reader
+	def save_page_images(self, directory):
+		self.page_images_dir = directory
+
+	def save_page_image(self, page):
+		path = os.path.join(self.page_images_dir, *PanelsExport.page_path(page))
+		os.makedirs(os.path.dirname(path), exist_ok = True)
+
+		if page.file_bytes is not None:
+			with open(path, 'wb') as fh:
+				fh.write(page.file_bytes)
+		elif page.pdf_page is not None:
+			cv.imencode('.png', page.pdf_page.render())[1].tofile(path)
+
+	def save_panels(self, output_base_path = 'auto', output_format = "jpg", quality = None):
+		self.start_panels_export(output_base_path, output_format, quality)
+		self.end_panels_export()
+
+	# Save panels of pages parsed from now on (and of those already parsed) as image files, while parsing goes on
+	def start_panels_export(self, output_base_path = 'auto', output_format = "jpg", quality = None):
 		if output_base_path == 'auto':
 			output_base_path = tempfile.mkdtemp(prefix = "kumiko-out-")
 		elif not os.path.isdir(output_base_path):
@@ -113,18 +361,33 @@ class Kumiko:
 			)
 			sys.exit(1)
 
-		nb_written_panels = 0
+		self.panels_export = PanelsExport(output_base_path, output_format, quality)
 		for page in self.page_list:
-			output_path = os.path.join(output_base_path, os.path.basename(page.filename))
-			os.makedirs(output_path, exist_ok = True)
-
-			for i, panel in enumerate(page.panels):
-				x, y, width, height = panel.to_xywh()
-				output_file = os.path.join(output_path, f"panel_{i}.{output_format}")
-				panel = page.img[y:y + height, x:x + width]
-				if cv.imwrite(output_file, panel):
-					nb_written_panels += 1
-				else:
-					print(f"\n[ERROR] Failed to write panel image to {output_file}\n", file = sys.stderr)
-
-		print(f"Saved {nb_written_panels} panel images to {output_base_path}", file = sys.stderr)
+			self.panels_export.add(page)
+
+	def end_panels_export(self):
+		export = self.panels_export
+		export.close()
+		self.panels_export = None
+
+		print(f"Saved {export.nb_written_panels} panel images to {export.output_base_path}", file = sys.stderr)
+		if self.options['progress']:
+			print(
+				f"Panels export: {export.encode_time:.2f}s encoding panels",
+				f"and {export.decode_time:.2f}s decoding pages on {export.threads} thread(s),",
+				f"{export.wait_time:.2f}s waited for them",
+				f"after {export.detection_time:.2f}s detecting panels",
+				file = sys.stderr
+			)
+
+	# Peak resident memory of this process, and of its largest worker process if any, in bytes
+	def peak_memory(self):
+		if resource is None:
+			return None, None
+
+		unit = 1 if sys.platform == 'darwin' else 1024  # ru_maxrss is in bytes on macOS, in kilobytes elsewhere
+		peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit
+		if self.options['jobs'] == 1:
+			return peak_memory, None
+
+		return peak_memory, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * unit
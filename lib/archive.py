@@ -0,0 +1,60 @@
+import os
+import re
+import queue
+import threading
+import zipfile
+
+
+# Comic book archive (CBZ/ZIP, or CBR/RAR with the optional rarfile module), whose images are read in memory,
+# without extracting them to disk. Given filename may be a file object too, e.g. an uploaded file.
+class Archive:
+
+	IMAGE_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.webp', '.bmp', '.tif', '.tiff']
+
+	def __init__(self, filename):
+		self.filename = filename
+
+		# archive type is given by contents rather than extension, some CBR files are actually ZIP files and vice versa
+		if zipfile.is_zipfile(filename):
+			self.archive = zipfile.ZipFile(filename)
+		else:
+			import rarfile  # needs one of unrar, unar, 7z or bsdtar tools too
+			if not rarfile.is_rarfile(filename):
+				raise ValueError(f"File {filename} is neither a ZIP nor a RAR archive")
+			self.archive = rarfile.RarFile(filename)
+
+		# image entries, in natural order: page2.jpg comes before page10.jpg
+		entries = filter(lambda e: not e.is_dir() and Archive.is_image(e.filename), self.archive.infolist())
+		self.entries = sorted(map(lambda e: e.filename, entries), key = Archive.natural_key)
+
+	@staticmethod
+	def is_image(entry):
+		if entry.startswith('__MACOSX/') or os.path.basename(entry).startswith('.'):
+			return False
+		return os.path.splitext(entry)[1].lower() in Archive.IMAGE_EXTENSIONS
+
+	@staticmethod
+	def natural_key(entry):
+		return [int(part) if part.isdigit() else part.lower() for part in re.split(r'(\d+)', entry)]
+
+	# Entries' contents, in order: a background thread decompresses them, up to `prefetch` entries ahead,
+	# while previous ones are being processed
+	def read_entries(self, prefetch = 4):
+		contents = queue.Queue(maxsize = prefetch)
+
+		def read():
+			try:
+				for entry in self.entries:
+					contents.put(self.archive.read(entry))
+			except Exception as e:
+				contents.put(e)
+
+		threading.Thread(target = read, daemon = True).start()
+
+		for _ in self.entries:
+			content = contents.get()
+			if isinstance(content, Exception):
+				raise content
+			yield content
+
+		self.archive.close()
@@ -0,0 +1,100 @@
+import os
+import json
+import hashlib
+import tempfile
+
+
+# On-disk cache of pages' infos, keyed by image contents, detection options and algorithm version.
+# Entries are small JSON files, least recently used ones are evicted once the cache grows over max_size bytes.
+class Cache:
+
+	DEFAULT_MAX_SIZE = 100 * 1024 * 1024
+
+	@staticmethod
+	def default_dir():
+		cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+		return os.path.join(cache_home, 'kumiko')
+
+	def __init__(self, directory = None, max_size = None):
+		self.directory = directory or Cache.default_dir()
+		self.max_size = max_size or Cache.DEFAULT_MAX_SIZE
+		self.size = None  # computed lazily, on first write
+
+		os.makedirs(self.directory, exist_ok = True)
+
+	@staticmethod
+	def key(file_bytes, options, version):
+		image_hash = hashlib.sha256(file_bytes).hexdigest()
+		options = json.dumps(options, sort_keys = True)
+		return hashlib.sha256(f"{version}:{image_hash}:{options}".encode()).hexdigest()
+
+	def path(self, key):
+		return os.path.join(self.directory, key[:2], key + '.json')
+
+	def get(self, key):
+		path = self.path(key)
+		try:
+			with open(path, encoding = "utf8") as fh:
+				infos = json.load(fh)
+		except (OSError, json.decoder.JSONDecodeError):
+			return None
+
+		# mark entry as recently used
+		try:
+			os.utime(path)
+		except OSError:
+			pass
+
+		return infos
+
+	def set(self, key, infos):
+		path = self.path(key)
+		os.makedirs(os.path.dirname(path), exist_ok = True)
+
+		# write to a temporary file first, so that concurrent readers never see a partial entry
+		fd, tmp_path = tempfile.mkstemp(dir = os.path.dirname(path), suffix = '.tmp')
+		with os.fdopen(fd, 'w', encoding = "utf8") as fh:
+			json.dump(infos, fh)
+		if self.size is not None:
+			try:
+				self.size -= os.path.getsize(path)  # entry is overwritten
+			except OSError:
+				pass
+		os.replace(tmp_path, path)
+
+		if self.size is None:
+			self.size = sum(map(lambda e: e[2], self.entries()))
+		else:
+			self.size += os.path.getsize(path)
+
+		if self.size > self.max_size:
+			self.evict()
+
+	def entries(self):
+		entries = []
+		for root, _, files in os.walk(self.directory):
+			for f in files:
+				if not f.endswith('.json'):
+					continue
+				path = os.path.join(root, f)
+				try:
+					stat = os.stat(path)
+				except OSError:
+					continue
+				entries.append((path, stat.st_mtime, stat.st_size))
+
+		return entries
+
+	def evict(self):
+		entries = sorted(self.entries(), key = lambda e: e[1])
+		self.size = sum(map(lambda e: e[2], entries))
+
+		# drop least recently used entries, down to 90% of max size, not to evict again on next write
+		for path, _, size in entries:
+			if self.size <= self.max_size * 0.9:
+				break
+			try:
+				os.remove(path)
+			except OSError:
+				continue
+			self.size -= size
@@ -40,11 +40,15 @@ class Debug:
 		Debug.base_img = img
 		Debug.img = np.copy(img)
 
+	# infos may be given as a function, only called when debugging
 	@staticmethod
 	def add_step(name, infos):
 		if not Debug.debug:
 			return
 
+		if callable(infos):
+			infos = infos()
+
 		elapsed = Debug.show_time(f"{name} ({len(infos['panels'])} panels)")
 
 		Debug.steps.append({
@@ -0,0 +1,33 @@
+# Union-find structure, to cluster items linked two by two
+class DisjointSet:
+
+	def __init__(self):
+		self.parents = {}
+		self.items = []  # in order of addition
+
+	def add(self, item):
+		if item not in self.parents:
+			self.parents[item] = item
+			self.items.append(item)
+
+	def find(self, item):
+		while self.parents[item] != item:
+			self.parents[item] = self.parents[self.parents[item]]  # path halving
+			item = self.parents[item]
+		return item
+
+	def union(self, item1, item2):
+		self.add(item1)
+		self.add(item2)
+		root1 = self.find(item1)
+		root2 = self.find(item2)
+		if root1 != root2:
+			self.parents[root2] = root1
+
+	# lists of items in each set, sets ordered by their first added item, items in order of addition
+	def groups(self):
+		groups = {}
+		for item in self.items:
+			groups.setdefault(self.find(item), []).append(item)
+
+		return list(groups.values())
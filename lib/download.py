@@ -0,0 +1,110 @@
+import sys
+import threading
+import collections
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+
+class DownloadException(Exception):
+	pass
+
+
+# Semaphore acquired in order by waiting threads. With threading.Semaphore, a thread releasing it may acquire it again
+# right away for its next download, so that a waiting download could be delayed until all later ones are done.
+class FifoSemaphore:
+
+	def __init__(self, value):
+		self.value = value
+		self.waiters = collections.deque()
+		self.lock = threading.Lock()
+
+	def __enter__(self):
+		with self.lock:
+			if self.value > 0 and len(self.waiters) == 0:
+				self.value -= 1
+				return
+			waiter = threading.Event()
+			self.waiters.append(waiter)
+		waiter.wait()  # released semaphore is handed over by __exit__
+
+	def __exit__(self, *args):
+		with self.lock:
+			if len(self.waiters) > 0:
+				self.waiters.popleft().set()
+			else:
+				self.value += 1
+
+
+# Downloads of image files in memory, by a pool of threads sharing keep-alive connections,
+# with a limited number of concurrent downloads from each host
+class Downloader:
+
+	MAX_WORKERS = 8
+	MAX_PER_HOST = 4
+	MAX_SIZE = 50 * 1024 * 1024
+	TIMEOUT = 5
+
+	def __init__(self, max_workers = None, max_per_host = None, max_size = None, timeout = None):
+		self.max_workers = max_workers or Downloader.MAX_WORKERS
+		self.max_per_host = max_per_host or Downloader.MAX_PER_HOST
+		self.max_size = max_size or Downloader.MAX_SIZE
+		self.timeout = timeout or Downloader.TIMEOUT
+
+		self.session = requests.Session()
+		adapter = requests.adapters.HTTPAdapter(pool_connections = self.max_workers, pool_maxsize = self.max_workers)
+		self.session.mount('http://', adapter)
+		self.session.mount('https://', adapter)
+
+		self.hosts = {}  # semaphore of each host
+		self.hosts_lock = threading.Lock()
+
+	def host_semaphore(self, host):
+		with self.hosts_lock:
+			if host not in self.hosts:
+				self.hosts[host] = FifoSemaphore(self.max_per_host)
+			return self.hosts[host]
+
+	# Contents of given URLs, in order, as soon as they are downloaded: None for URLs that could not be downloaded.
+	# Only a few downloads run ahead of the consumer, not to hold too many files in memory.
+	def download_all(self, urls):
+		with ThreadPoolExecutor(max_workers = self.max_workers) as executor:
+			pending = collections.deque()
+			for url in urls:
+				pending.append(executor.submit(self.download, url))
+				if len(pending) > 2 * self.max_workers:
+					yield pending.popleft().result()
+
+			while len(pending) > 0:
+				yield pending.popleft().result()
+
+	# Contents of given URL, None if it could not be downloaded
+	def download(self, url):
+		try:
+			return self.fetch(url)
+		except DownloadException as e:
+			print(f"\n[ERROR] Could not download {url}, will be ignored: {e}\n", file = sys.stderr)
+			return None
+
+	# Contents of given URL, raises an exception if it could not be downloaded
+	def fetch(self, url):
+		parts = urlparse(url)
+		if not parts.netloc or not parts.path:
+			raise DownloadException("not a file URL")
+
+		try:
+			with self.host_semaphore(parts.netloc):
+				with self.session.get(url, timeout = self.timeout, stream = True) as r:
+					r.raise_for_status()
+					if int(r.headers.get('Content-Length') or 0) > self.max_size:
+						raise DownloadException(f"larger than {self.max_size} bytes")
+
+					contents = bytearray()
+					for chunk in r.iter_content(chunk_size = 64 * 1024):
+						contents += chunk
+						if len(contents) > self.max_size:
+							raise DownloadException(f"larger than {self.max_size} bytes")
+		except requests.RequestException as e:
+			raise DownloadException(str(e)) from None
+
+		return bytes(contents)
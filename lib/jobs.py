@@ -0,0 +1,111 @@
+import time
+import uuid
+import threading
+import collections
+
+
+# Batch of pages processed in the background by a worker pool, a few at a time, whose results are available
+# as soon as each page is done: fn(*args) gives infos of the page with given filename, for each args in tasks.
+class Job:
+
+	def __init__(self, pool, fn, filenames, tasks):
+		self.id = uuid.uuid4().hex
+		self.filenames = filenames
+		self.nb_pages = len(filenames)
+		self.results = [None] * self.nb_pages  # page infos, or error
+		self.done = [False] * self.nb_pages
+		self.nb_done = 0
+		self.started = time.time()
+		self.finished = None
+		self.condition = threading.Condition()
+
+		threading.Thread(target = self.run, args = (pool, fn, tasks), daemon = True).start()
+
+	def run(self, pool, fn, tasks):
+		# as many pages processed at once as the pool's background slots, other slots are left to interactive requests
+		pending = collections.deque()
+		try:
+			for i, args in enumerate(tasks):
+				pending.append((i, pool.submit_background(fn, *args)))
+				if len(pending) >= pool.background_slots:
+					self.collect(*pending.popleft())
+		except Exception as e:  # e.g. a corrupted archive: remaining pages are failed
+			for i in range(len(pending) + self.nb_done, self.nb_pages):
+				self.set_error(i, e)
+
+		while len(pending) > 0:
+			self.collect(*pending.popleft())
+
+		with self.condition:
+			self.finished = time.time()
+			self.condition.notify_all()
+
+	def collect(self, i, future):
+		try:
+			self.set_result(i, future.result())
+		except Exception as e:
+			self.set_error(i, e)
+
+	def set_error(self, i, e):
+		self.set_result(i, {'filename': self.filenames[i], 'error': str(e) or e.__class__.__name__})
+
+	def set_result(self, i, result):
+		with self.condition:
+			self.results[i] = result
+			self.done[i] = True
+			self.nb_done += 1
+			self.condition.notify_all()
+
+	def status(self):
+		with self.condition:
+			return {
+				'id': self.id,
+				'status': 'done' if self.finished else 'running',
+				'nb_pages': self.nb_pages,
+				'nb_done': self.nb_done,
+				'time': (self.finished or time.time()) - self.started,
+				'pages': list(self.results),
+			}
+
+	# Pages' infos, in order, as soon as each page is done, pages that failed are skipped
+	def pages(self):
+		for i in range(self.nb_pages):
+			with self.condition:
+				self.condition.wait_for(lambda: self.done[i])
+				result = self.results[i]
+			if 'error' not in result:
+				yield result
+
+
+# Jobs by id, kept for `ttl` seconds once finished
+class Jobs:
+
+	TTL = 3600
+
+	def __init__(self, max_running, ttl = None):
+		self.max_running = max_running
+		self.ttl = ttl or Jobs.TTL
+		self.jobs = {}
+		self.lock = threading.Lock()
+
+	# New job, None if `max_running` jobs are running already
+	def add(self, pool, fn, filenames, tasks):
+		with self.lock:
+			now = time.time()
+			self.jobs = {i: job for i, job in self.jobs.items() if not job.finished or job.finished > now - self.ttl}
+			if len(list(filter(lambda job: not job.finished, self.jobs.values()))) >= self.max_running:
+				return None
+
+			job = Job(pool, fn, filenames, tasks)
+			self.jobs[job.id] = job
+			return job
+
+	def get(self, job_id):
+		with self.lock:
+			return self.jobs.get(job_id)
+
+	def counts(self):
+		with self.lock:
+			jobs = list(self.jobs.values())
+		nb_running = len(list(filter(lambda job: not job.finished, jobs)))
+		return {'running': nb_running, 'done': len(jobs) - nb_running}
@@ -1,13 +1,16 @@
-import math
 import os
 import json
 import sys
 import time
+import heapq
 import cv2 as cv
 import numpy as np
 
 from lib.panel import Panel
-from lib.segment import Segment
+from lib.segment import Segment, SegmentSet
+from lib.panel_index import PanelList, PanelIndex
+from lib.panel_array import PanelArray
+from lib.disjoint_set import DisjointSet
 from lib.debug import Debug
 
 
@@ -19,11 +22,14 @@ class Page:
 
 	DEFAULT_MIN_PANEL_SIZE_RATIO = 1 / 10
 
+	# bump this whenever a change in panel detection may change results, to invalidate cached infos (see lib/cache.py)
+	ALGORITHM_VERSION = 4
+
 	def get_infos(self):
 		actual_gutters = self.actual_gutters()
 
 		return {
-			'filename': self.url if self.url else os.path.basename(self.filename),
+			'filename': self.url or self.name or os.path.basename(self.filename),
 			'size': self.img_size,
 			'numbering': self.numbering,
 			'gutters': [actual_gutters['x'], actual_gutters['y']],
@@ -32,27 +38,242 @@ class Page:
 			'processing_time': self.processing_time
 		}
 
+	# pixel buffers are not pickled, e.g. when pages come back from Kumiko's worker processes
+	PIXEL_BUFFERS = ['img', 'gray', 'sobel', 'contours']
+
+	def __getstate__(self):
+		state = self.__dict__.copy()
+		for attr in Page.PIXEL_BUFFERS:
+			state[attr] = None
+		state['panel_index'] = None
+		return state
+
+	@property
+	def panels(self):
+		return self._panels
+
+	@panels.setter
+	def panels(self, panels):
+		self._panels = PanelList(self, panels)
+		self.panels_changed()
+
+	# Values computed from panels' geometry are cached, until panels are added, removed or reordered
+	def panels_changed(self):
+		self.panel_index = None  # index for panels' neighbour queries
+		self.gutters = {}  # actual gutters, by aggregate function
+		self.extents = None  # furthest known edges
+
+	# ... or until a panel edge moves
+	def panel_moved(self, panel, edge, old, new):
+		index = getattr(self, 'panel_index', None)
+		if index is not None:
+			index.move(panel, edge, old, new)
+
+		self.gutters = {}
+
+		# extents stay the same while edges move within the frame, and not away from it
+		extents = getattr(self, 'extents', None)
+		if extents is not None and new != extents[edge]:
+			beyond = new < extents[edge] if edge in ['x', 'y'] else new > extents[edge]
+			if beyond or old == extents[edge]:
+				self.extents = None
+
+	def get_panel_index(self):
+		if self.panel_index is None:
+			self.panel_index = PanelIndex(self.panels)
+		return self.panel_index
+
+	# Frame around all panels
+	def get_extents(self):
+		if self.extents is None:
+			self.extents = {
+				'x': min(map(lambda p: p.x, self.panels)),
+				'y': min(map(lambda p: p.y, self.panels)),
+				'r': max(map(lambda p: p.r, self.panels)),
+				'b': max(map(lambda p: p.b, self.panels)),
+			}
+		return self.extents
+
+	@staticmethod
+	def cache_options(
+		numbering = None,
+		url = None,
+		name = None,
+		min_panel_size_ratio = None,
+		panel_expansion = True,
+		detection_size = None,
+		detection_scale = None
+	):
+		# options that change detection results (url and name do not)
+		return {
+			'numbering': numbering or "ltr",
+			'min_panel_size_ratio': min_panel_size_ratio or Page.DEFAULT_MIN_PANEL_SIZE_RATIO,
+			'panel_expansion': panel_expansion,
+			'detection_size': detection_size,
+			'detection_scale': detection_scale,
+		}
+
+	# Rebuild a page from its (cached) infos, without decoding nor processing the image
+	@staticmethod
+	def from_infos(
+		filename,
+		infos,
+		numbering = None,
+		url = None,
+		name = None,
+		min_panel_size_ratio = None,
+		panel_expansion = True,
+		detection_size = None,
+		detection_scale = None,
+		file_bytes = None,
+		pdf_page = None
+	):
+		page = Page.__new__(Page)
+
+		page.filename = filename
+		page.file_bytes = file_bytes
+		page.pdf_page = pdf_page
+		page.url = url
+		page.name = name
+		page.numbering = numbering or "ltr"
+		page.small_panel_ratio = min_panel_size_ratio or Page.DEFAULT_MIN_PANEL_SIZE_RATIO
+		page.panel_expansion = panel_expansion
+		page.img_size = infos['size']
+		page.detection_scale = Page.get_detection_scale(page.img_size, detection_size, detection_scale)
+		page.license = Page.read_license(filename)
+		page.processing_time = infos['processing_time']
+
+		for attr in Page.PIXEL_BUFFERS:
+			setattr(page, attr, None)
+		page.segments = []
+		page.segment_set = SegmentSet(page.segments)
+		page.panels = list(map(lambda xywh: Panel(page = page, xywh = xywh), infos['panels']))
+
+		return page
+
+	@staticmethod
+	def read_license(filename):
+		if not os.path.isfile(filename + '.license'):
+			return None
+
+		with open(filename + '.license', encoding = "utf8") as fh:
+			try:
+				return json.load(fh)
+			except json.decoder.JSONDecodeError:
+				print(f"License file {filename+'.license'} is not a valid JSON file", file = sys.stderr)
+				sys.exit(1)
+
+	# Scale factor (<= 1) of the image panels are detected on: given scale, or whatever fits the longest edge in given size
+	@staticmethod
+	def get_detection_scale(img_size, detection_size = None, detection_scale = None):
+		scale = 1
+		if detection_scale:
+			scale = min(scale, detection_scale)
+		if detection_size:
+			scale = min(scale, detection_size / max(img_size))
+
+		return scale
+
+	def get_img(self):
+		if self.img is None:
+			self.img = Page.read_img(self.filename, file_bytes = self.file_bytes, pdf_page = self.pdf_page)
+		return self.img
+
+	# Image decoded from given file, or from given file contents (e.g. read from an archive), or rendered from a PDF page
+	@staticmethod
+	def read_img(filename, flags = cv.IMREAD_COLOR, file_bytes = None, pdf_page = None):
+		if pdf_page is not None:
+			return pdf_page.render(flags)
+
+		return cv.imdecode(Page.file_buffer(filename, file_bytes), flags) # decodifica
+
+	@staticmethod
+	def file_buffer(filename, file_bytes = None):
+		if file_bytes is not None:
+			return np.frombuffer(file_bytes, dtype = np.uint8)
+
+		# Lidando com caminhos de arquivos com caracteres especiais, como acentos
+		return np.fromfile(filename, dtype=np.uint8) # ler o arquivo como binário
+
+	# Grayscale pixels decoded straight from the file, and the image [width,height] size.
+	# When panels are detected on a downscaled image, JPEG files are decoded at 1/8, 1/4 or 1/2 of their size,
+	# as long as that is at least twice the detection size, for the final downscaling to still average pixels.
+	@staticmethod
+	def read_gray(file_bytes, detection_size = None, detection_scale = None):
+		size = Page.jpeg_size(file_bytes) if detection_size or detection_scale else None
+		if size:
+			scale = Page.get_detection_scale(size, detection_size, detection_scale)
+			for reduction, flags in [
+				(8, cv.IMREAD_REDUCED_GRAYSCALE_8),
+				(4, cv.IMREAD_REDUCED_GRAYSCALE_4),
+				(2, cv.IMREAD_REDUCED_GRAYSCALE_2),
+			]:
+				if scale * reduction * 2 <= 1:
+					gray = cv.imdecode(file_bytes, flags)
+					# rotated images (EXIF orientation) are decoded again, at full size
+					if gray is not None and list(gray.shape) == [-(-size[1] // reduction), -(-size[0] // reduction)]:
+						return gray, size
+					break
+
+		gray = cv.imdecode(file_bytes, cv.IMREAD_GRAYSCALE)
+		return gray, None if gray is None else [gray.shape[1], gray.shape[0]]
+
+	# [width,height] from a JPEG file's frame header, None for other files
+	@staticmethod
+	def jpeg_size(file_bytes):
+		data = memoryview(file_bytes)
+		if data[:2] != b'\xff\xd8':
+			return None
+
+		i = 2
+		while i + 9 <= len(data):
+			if data[i] != 0xff:
+				return None
+			marker = data[i + 1]
+			if marker == 0xff:  # fill byte
+				i += 1
+				continue
+			if 0xc0 <= marker <= 0xcf and marker not in [0xc4, 0xc8, 0xcc]:  # start of frame
+				return [data[i + 7] << 8 | data[i + 8], data[i + 5] << 8 | data[i + 6]]
+			i += 2 + (data[i + 2] << 8 | data[i + 3])
+
+		return None
+
 	def __init__(
 		self,
 		filename,
 		numbering = None,
 		debug = False,
 		url = None,
+		name = None,
 		min_panel_size_ratio = None,
-		panel_expansion = True
+		panel_expansion = True,
+		detection_size = None,
+		detection_scale = None,
+		file_bytes = None,
+		pdf_page = None
 	):
 		self.filename = filename
+		self.file_bytes = file_bytes  # file contents, for images not read from disk
+		self.pdf_page = pdf_page  # for pages rendered from a PDF file, see lib/pdf.py
 		self.panels = []
 		self.segments = []
 
 		self.processing_time = None
 		t1 = time.time_ns()
 
-		# Lidando com caminhos de arquivos com caracteres especiais, como acentos
-		file_bytes = np.fromfile(filename, dtype=np.uint8) # ler o arquivo como binário
-		self.img = cv.imdecode(file_bytes, cv.IMREAD_COLOR) # decodifica
-
-		if not isinstance(self.img, np.ndarray) or self.img.size == 0:
+		# colour pixels are only needed to save panels or debug images, see get_img()
+		self.img = None
+		if pdf_page is not None:
+			# rendered straight at detection resolution
+			self.img_size = pdf_page.size()
+			scale = Page.get_detection_scale(self.img_size, detection_size, detection_scale)
+			self.gray = pdf_page.render(cv.IMREAD_GRAYSCALE, scale)
+		else:
+			file_buffer = Page.file_buffer(filename, file_bytes)
+			self.gray, self.img_size = Page.read_gray(file_buffer, detection_size, detection_scale)
+
+		if not isinstance(self.gray, np.ndarray) or self.gray.size == 0:
 			raise NotAnImageException(f"File {filename} is not an image")
 
 		self.numbering = numbering or "ltr"
@@ -62,28 +283,30 @@ class Page:
 		self.small_panel_ratio = min_panel_size_ratio or Page.DEFAULT_MIN_PANEL_SIZE_RATIO
 		self.panel_expansion = panel_expansion
 		self.url = url
+		self.name = name  # page's name in infos and panels export, rather than its file's basename
 
-		self.img_size = list(self.img.shape[:2])
-		self.img_size.reverse()  # get a [width,height] list
+		# panels may be detected on a downscaled image, their coordinates are scaled back at the end
+		self.detection_scale = Page.get_detection_scale(self.img_size, detection_size, detection_scale)
+		self.original_size = self.img_size
+		if self.detection_scale < 1:
+			self.img_size = [
+				max(1, round(self.img_size[0] * self.detection_scale)),
+				max(1, round(self.img_size[1] * self.detection_scale)),
+			]
 
 		Debug.contour_size = 3
 
 		# get license for this file
-		self.license = None
-		if os.path.isfile(filename + '.license'):
-			with open(filename + '.license', encoding = "utf8") as fh:
-				try:
-					self.license = json.load(fh)
-				except json.decoder.JSONDecodeError:
-					print(f"License file {filename+'.license'} is not a valid JSON file", file = sys.stderr)
-					sys.exit(1)
-
-		Debug.set_base_img(self.img)
-
-		Debug.add_step('Initial state', self.get_infos())
+		self.license = Page.read_license(filename)
+
+		if Debug.debug:
+			Debug.set_base_img(self.get_img() if self.detection_scale == 1 else self.downscale(self.get_img()))
+
+		Debug.add_step('Initial state', self.get_infos)
 		Debug.add_image('Input image')
 
-		self.gray = cv.cvtColor(self.img, cv.COLOR_BGR2GRAY)
+		if [self.gray.shape[1], self.gray.shape[0]] != self.img_size:
+			self.gray = self.downscale(self.gray)
 		Debug.add_image('Shades of gray', img = self.gray)
 		Debug.show_time("Shades of gray")
 
@@ -122,8 +345,24 @@ class Page:
 
 		self.fix_panels_numbering()
 
+		if self.detection_scale < 1:
+			self.upscale_panels()
+
 		self.processing_time = int((time.time_ns() - t1) / 10**7) / 100
 
+	def downscale(self, img):
+		return cv.resize(img, tuple(self.img_size), interpolation = cv.INTER_AREA)
+
+	# Map panels found on the downscaled image back onto the original image
+	def upscale_panels(self):
+		for p in self.panels:
+			p.x = min(int(round(p.x / self.detection_scale)), self.original_size[0])
+			p.y = min(int(round(p.y / self.detection_scale)), self.original_size[1])
+			p.r = min(int(round(p.r / self.detection_scale)), self.original_size[0])
+			p.b = min(int(round(p.b / self.detection_scale)), self.original_size[1])
+
+		self.img_size = self.original_size
+
 	def get_contours(self):
 		# Black background: values above 100 will be black, the rest white
 		_, thresh = cv.threshold(self.sobel, 100, 255, cv.THRESH_BINARY)
@@ -135,36 +374,28 @@ class Page:
 		Debug.show_time("Get contours")
 
 	def get_segments(self):
-		self.segments = None
+		self.segments = []
 
 		lsd = cv.createLineSegmentDetector(0)
 		dlines = lsd.detect(self.gray)
 
 		Debug.show_time("Detected segments")
 
-		min_dist = min(self.img_size) * self.small_panel_ratio
+		if dlines is not None and dlines[0] is not None:
+			lines = np.rint(dlines[0].reshape(-1, 4)).astype(np.int64)
+			dists = np.sqrt((lines[:, 0] - lines[:, 2])**2 + (lines[:, 1] - lines[:, 3])**2)
 
-		while self.segments is None or len(self.segments) > 500:
-			self.segments = []
-
-			if dlines is None or dlines[0] is None:
-				break
+			# raise the minimal length by 10% steps until there are no more than 500 segments left
+			min_dist = min(self.img_size) * self.small_panel_ratio
+			sorted_dists = np.sort(dists)
+			while len(dists) - np.searchsorted(sorted_dists, min_dist) > 500:
+				min_dist *= 1.1
 
-			for dline in dlines[0]:
-				x0 = int(round(dline[0][0]))
-				y0 = int(round(dline[0][1]))
-				x1 = int(round(dline[0][2]))
-				y1 = int(round(dline[0][3]))
-
-				a = x0 - x1
-				b = y0 - y1
-				dist = math.sqrt(a**2 + b**2)
-				if dist >= min_dist:
-					self.segments.append(Segment([x0, y0], [x1, y1]))
-
-			min_dist *= 1.1
+			for x0, y0, x1, y1 in lines[dists >= min_dist].tolist():
+				self.segments.append(Segment([x0, y0], [x1, y1]))
 
 		self.segments = Segment.union_all(self.segments)
+		self.segment_set = SegmentSet(self.segments)
 
 		Debug.draw_segments(self.segments, Debug.colours['green'])
 		Debug.add_image("Segment Detector")
@@ -187,87 +418,154 @@ class Page:
 			self.panels.append(panel)
 
 		Debug.add_image('Initial contours')
-		Debug.add_step('Panels from initial contours', self.get_infos())
+		Debug.add_step('Panels from initial contours', self.get_infos)
 
 	# Group small panels that are close together, into bigger ones
 	def group_small_panels(self):
 		small_panels = list(filter(lambda p: p.is_small(), self.panels))
-		groups = {}
-		group_id = 0
 
-		for i, p1 in enumerate(small_panels):
-			for p2 in small_panels[i + 1:]:
-				if p1 == p2:
-					continue
+		# panels with the same coordinates count as one (first one found), unless they are empty
+		def key(p):
+			return (p.x, p.y, p.r, p.b) if p.w() > 0 and p.h() > 0 else id(p)
 
-				if not p1.is_close(p2):
-					continue
+		panels_by_key = {}
+		groups = DisjointSet()
+		for i, j in Page.close_panel_pairs(small_panels):
+			p1 = panels_by_key.setdefault(key(small_panels[i]), small_panels[i])
+			p2 = panels_by_key.setdefault(key(small_panels[j]), small_panels[j])
+			groups.union(key(p1), key(p2))
+
+		grouped = list(map(lambda keys: [panels_by_key[k] for k in keys], groups.groups()))
 
-				if p1 not in groups and p2 not in groups:
-					group_id += 1
-					groups[p1] = group_id
-					groups[p2] = group_id
-				elif p1 in groups and p2 not in groups:
-					groups[p2] = groups[p1]
-				elif p2 in groups and p1 not in groups:
-					groups[p1] = groups[p2]
-				elif groups[p1] != groups[p2]:
-					# group group1 and group2 together
-					for p, id in groups.items():
-						if id == groups[p2]:
-							groups[p] = groups[p1]
-
-		grouped = {}
-		for k, v in groups.items():
-			grouped[v] = grouped.get(v, []) + [k]
-
-		for small_panels in grouped.values():
+		# remove grouped panels, like successive self.panels.remove() calls would (first equal panel in list)
+		panels = list(self.panels)
+		xyrb = np.array([[p.x, p.y, p.r, p.b] for p in panels], dtype = np.int64).reshape(-1, 4)
+		xyrb = np.concatenate([xyrb, np.zeros((len(grouped), 4), dtype = np.int64)])
+		alive = np.zeros(len(xyrb), dtype = bool)
+		alive[:len(panels)] = True
+		positions = {id(p): i for i, p in enumerate(panels)}
+
+		for small_panels in grouped:
 			big_hull = cv.convexHull(np.concatenate(list(map(lambda p: p.polygon, small_panels))))
 			big_panel = Panel(page = self, polygon = big_hull, splittable = False)
 
-			self.panels.append(big_panel)
+			xyrb[len(panels)] = [big_panel.x, big_panel.y, big_panel.r, big_panel.b]
+			alive[len(panels)] = True
+			panels.append(big_panel)
+
 			for p in small_panels:
-				self.panels.remove(p)
+				equal = Page.equal_panels(xyrb, p)
+				i = positions.get(id(p))
+				if i is not None:
+					equal[i] = True
+				equal &= alive
+
+				if not equal.any():
+					raise ValueError('list.remove(x): x not in list')
+				alive[np.argmax(equal)] = False
 
 			Debug.draw_contours(list(map(lambda p: p.polygon, small_panels)), Debug.colours['lightblue'])
 			Debug.draw_contours([big_panel.polygon], Debug.colours['red'])
 
-		if group_id > 0:
+		if len(grouped) > 0:
+			self.panels = [p for p, keep in zip(panels, alive) if keep]
 			Debug.add_image('Group small panels')
-		Debug.add_step('Group small panels', self.get_infos())
+		Debug.add_step('Group small panels', self.get_infos)
+
+	CLOSE_PANELS_BLOCK = 256  # rows of the pairwise distance matrix computed at once
+
+	# Pairs (i, j), i < j, of panels that are close but not equal (see Panel.is_close and Panel.__eq__), sorted
+	@staticmethod
+	def close_panel_pairs(panels):
+		xyrb = np.array([[p.x, p.y, p.r, p.b] for p in panels], dtype = np.int64).reshape(-1, 4)
+		w = xyrb[:, 2] - xyrb[:, 0]
+		h = xyrb[:, 3] - xyrb[:, 1]
+		cx = xyrb[:, 0] + w / 2
+		cy = xyrb[:, 1] + h / 2
+
+		pairs = []
+		for start in range(0, len(panels), Page.CLOSE_PANELS_BLOCK):
+			rows = slice(start, start + Page.CLOSE_PANELS_BLOCK)
+			close = np.abs(cx[rows, None] - cx[None, :]) <= (w[rows, None] + w[None, :]) * 0.75
+			close &= np.abs(cy[rows, None] - cy[None, :]) <= (h[rows, None] + h[None, :]) * 0.75
+			close &= np.arange(len(panels))[None, :] > np.arange(len(panels))[rows, None]
+
+			wt = w[rows, None] / 10
+			ht = h[rows, None] / 10
+			equal = np.abs(xyrb[rows, None, 0] - xyrb[None, :, 0]) < wt
+			equal &= np.abs(xyrb[rows, None, 1] - xyrb[None, :, 1]) < ht
+			equal &= np.abs(xyrb[rows, None, 2] - xyrb[None, :, 2]) < wt
+			equal &= np.abs(xyrb[rows, None, 3] - xyrb[None, :, 3]) < ht
+			close &= ~equal
+
+			for i, j in zip(*np.nonzero(close)):
+				pairs.append((start + int(i), int(j)))
+
+		return pairs
+
+	# Mask of panels (N×4 xyrb array) that are equal to given panel, as in `panels[i] == panel`
+	@staticmethod
+	def equal_panels(xyrb, panel):
+		return PanelArray.boxes_equal(xyrb, PanelArray.box(panel))
 
 	# See if panels can be cut into several (two non-consecutive points are close)
+	# Split panels, biggest first (then in panels list order), until no panel can be split.
+	# A panel split only depends on its polygon and the page segments: once a panel could not be split,
+	# it never needs to be evaluated again, so only subpanels resulting from a split are queued.
 	def split_panels(self):
-		did_split = True
-		while did_split:
-			did_split = False
-			for p in sorted(self.panels, key = lambda p: p.area(), reverse = True):
-				split = p.split()
-				if split is not None:
-					did_split = True
-					self.panels.remove(p)
-					self.panels += split.subpanels
-
-					Debug.draw_contours(list(map(lambda n: n.polygon, split.subpanels)), Debug.colours['blue'])
-					Debug.draw_line(split.segment.a, split.segment.b, Debug.colours['red'])
-					break
+		panels = dict(enumerate(self.panels))  # by position in panels list, subpanels are appended at the end
+		queue = [(-p.area(), i) for i, p in panels.items()]
+		heapq.heapify(queue)
+		next_position = len(panels)
+		unsplittable = set()  # polygons that could not be split
+
+		while queue:
+			_, i = heapq.heappop(queue)
+			p = panels[i]
+			if p.splittable is False:
+				continue
+
+			polygon_key = Page.polygon_key(p.polygon)
+			if polygon_key in unsplittable:
+				p.splittable = False
+				continue
+
+			split = p.split()
+			if split is None:
+				unsplittable.add(polygon_key)
+				continue
+
+			del panels[i]
+			for subpanel in split.subpanels:
+				panels[next_position] = subpanel
+				heapq.heappush(queue, (-subpanel.area(), next_position))
+				next_position += 1
 
-			if did_split:
-				Debug.add_image(
-					'Split contours (blue contours, red split-segment, gray polygon dots, purple nearby dots)'
-				)
+			Debug.draw_contours(list(map(lambda n: n.polygon, split.subpanels)), Debug.colours['blue'])
+			Debug.draw_line(split.segment.a, split.segment.b, Debug.colours['red'])
+			Debug.add_image('Split contours (blue contours, red split-segment, gray polygon dots, purple nearby dots)')
 
-		Debug.add_step(f"Panels from split contours ({len(self.segments)} segments)", self.get_infos())
+		self.panels = list(panels.values())
+
+		Debug.add_step(f"Panels from split contours ({len(self.segments)} segments)", self.get_infos)
+
+	@staticmethod
+	def polygon_key(polygon):
+		return None if polygon is None else (polygon.shape, polygon.tobytes())
 
 	def exclude_small_panels(self):
-		self.panels = list(filter(lambda p: not p.is_small(), self.panels))
+		small = PanelArray(self.panels).is_small(self)
+		self.panels = [p for p, is_small in zip(self.panels, small) if not is_small]
 
-		Debug.add_step('Exclude small panels', self.get_infos())
+		Debug.add_step('Exclude small panels', self.get_infos)
 
 	# Splitting polygons may result in panels slightly overlapping, de-overlap them
 	def deoverlap_panels(self):
-		for p1 in self.panels:
-			for p2 in self.panels:
+		# panels only shrink below: panels apart from one another now will stay apart
+		neighbours = PanelArray(self.panels).intersecting()
+		for i, p1 in enumerate(self.panels):
+			for j in neighbours[i]:
+				p2 = self.panels[j]
 				if p1 == p2:
 					continue
 
@@ -285,27 +583,56 @@ class Page:
 					p2.y = opanel.b
 					continue
 
-		Debug.add_step('Deoverlap panels', self.get_infos())
+		Debug.add_step('Deoverlap panels', self.get_infos)
 
 	# Merge panels that shouldn't have been split (speech bubble diving into a panel)
 	def merge_panels(self):
+		panels = PanelArray(self.panels)
+		neighbours = panels.intersecting()
 		panels_to_remove = []
 		for i, p1 in enumerate(self.panels):
-			for j, p2 in enumerate(self.panels[i + 1:]):
+			# only panels that are not apart from p1 may contain it or be contained, look for them again when p1 grows
+			candidates = [j for j in neighbours[i] if j > i]
+			k = 0
+			while k < len(candidates):
+				j = candidates[k]
+				k += 1
+				p2 = self.panels[j]
+
 				if p1.contains(p2):
 					panels_to_remove.append(p2)
 					p1 = p1.merge(p2)
+					candidates = np.nonzero(~panels.apart(p1)[j + 1:])[0] + j + 1
+					k = 0
 				elif p2.contains(p1):
 					panels_to_remove.append(p1)
-					p2 = p2.merge(p1)
 
-		for p in set(panels_to_remove):
-			self.panels.remove(p)
+		# remove panels like successive self.panels.remove() calls would (first equal panel in list),
+		# deduplicated like a set would, in a stable order
+		alive = np.ones(len(self.panels), dtype = bool)
+		positions = {id(p): i for i, p in enumerate(self.panels)}
+		for p in dict.fromkeys(panels_to_remove):
+			equal = PanelArray.boxes_equal(panels.xyrb, PanelArray.box(p))
+			if id(p) in positions:
+				equal[positions[id(p)]] = True
+			equal &= alive
 
-		Debug.add_step('Merge panels', self.get_infos())
+			if not equal.any():
+				raise ValueError('list.remove(x): x not in list')
+			alive[np.argmax(equal)] = False
+
+		if not alive.all():
+			self.panels = [p for p, keep in zip(self.panels, alive) if keep]
+
+		Debug.add_step('Merge panels', self.get_infos)
 
 	# Find out actual gutters between panels
 	def actual_gutters(self, func = min):
+		if func not in self.gutters:
+			self.gutters[func] = self.compute_actual_gutters(func)
+		return dict(self.gutters[func])
+
+	def compute_actual_gutters(self, func):
 		gutters_x = []
 		gutters_y = []
 		for p in self.panels:
@@ -339,69 +666,148 @@ class Page:
 					newcoord = getattr(neighbour, {'x': 'r', 'r': 'x', 'y': 'b', 'b': 'y'}[d]) + gutters[d]
 				else:
 					# expand to the furthest known edge (frame around all panels)
-					min_panel = min(self.panels, key = lambda p: getattr(p, d)) if d in [
-						'x', 'y'
-					] else max(self.panels, key = lambda p: getattr(p, d))
-					newcoord = getattr(min_panel, d)
+					newcoord = self.get_extents()[d]
 
 				if newcoord != -1:
 					if d in ['r', 'b'] and newcoord > getattr(p, d) or d in ['x', 'y'] and newcoord < getattr(p, d):
 						setattr(p, d, newcoord)
 
-		Debug.add_step('Expand panels', self.get_infos())
+		Debug.add_step('Expand panels', self.get_infos)
 
 	# Fix panels simple sorting (issue #12)
+	# Panels must come after their top panel, and after their left panels (right panels in rtl numbering).
+	# Sort panels topologically along this "comes before" relation: panels stay where they are in the list,
+	# unless a panel that must come before is further in the list, then they move right after that panel.
 	def fix_panels_numbering(self):
-		changes = 1
-		while changes:
-			changes = 0
-			for i, p in enumerate(self.panels):
-				neighbours_before = [p.find_top_panel()]
-				neighbours_before += p.find_all_right_panels() if self.numbering == "rtl" else p.find_all_left_panels()
-
-				for neighbour in neighbours_before:
-					if neighbour is None:
-						continue
-					neighbour_pos = self.panels.index(neighbour)
-					if i < neighbour_pos:
-						changes += 1
-						self.panels.insert(neighbour_pos, self.panels.pop(i))
-						break
-				if changes > 0:
-					break  # start a new whole loop with reordered panels
-
-		Debug.add_step('Numbering fixed', self.get_infos())
+		panels = list(self.panels)
+		positions = {id(p): i for i, p in enumerate(panels)}
+
+		before = []  # panels that must come before
+		after = [[] for _ in panels]  # panels that must come after
+		for i, p in enumerate(panels):
+			neighbours_before = [p.find_top_panel()]
+			neighbours_before += p.find_all_right_panels() if self.numbering == "rtl" else p.find_all_left_panels()
+
+			before.append(set(positions[id(n)] for n in neighbours_before if n is not None) - {i})
+			for j in before[i]:
+				after[j].append(i)
+
+		# Sort keys: (i,) for a panel that stays in place, key + (-i,) for a panel that moves right after the panel
+		# with this key (panels moved after the same panel: last in list first), computed in topological order
+		keys = [None] * len(panels)
+		nb_before = list(map(len, before))
+		ready = [i for i in range(len(panels)) if nb_before[i] == 0]
+		heapq.heapify(ready)
+		while len(ready) > 0 or None in keys:
+			if len(ready) == 0:
+				# cycle: panels must come before one another, break it at the first remaining panel
+				ready.append(keys.index(None))
+
+			i = heapq.heappop(ready)
+			if keys[i] is not None:
+				continue
+
+			keys[i] = max([(i, )] + [keys[j] + (-i, ) for j in before[i] if keys[j] is not None])
+			for j in after[i]:
+				nb_before[j] -= 1
+				if nb_before[j] == 0:
+					heapq.heappush(ready, j)
+
+		self.panels = [panels[i] for i in sorted(range(len(panels)), key = lambda i: keys[i])]
+
+		Debug.add_step('Numbering fixed', self.get_infos)
 
 	# group big panels together
+	# Group two panels into their bounding box, if it neither bumps into other panels nor contains big segments.
+	# First pair in panels list order is grouped first, until no pair can be grouped.
+	# Whether a pair's box contains big segments, and whether it bumps into a given panel, never change:
+	# only the number of panels each pair bumps into is kept up to date, for pairs involving added/removed panels.
 	def group_big_panels(self):
-		grouped = True
-		while grouped:
-			grouped = False
-			for i, p1 in enumerate(self.panels):
-				for p2 in self.panels[i + 1:]:
-					p3 = p1.group_with(p2)
-
-					other_panels = [p for p in self.panels if p not in [p1, p2]]
-					if p3.bumps_into(other_panels):
-						continue
-
-					# are there big segments in this panel?
-					segments = []
-					for s in self.segments:
-						if p3.contains_segment(s) and s.dist() > p3.diagonal().dist() / 5:
-							if s not in segments:
-								segments.append(s)
-
-					if len(segments) > 0:  # maybe allow a small number of big segments here?
-						continue
-
-					self.panels.append(p3)
-					self.panels.remove(p1)
-					self.panels.remove(p2)
-					grouped = True
-					break
-
-				if grouped:
-					break
+		panels = list(self.panels)
+		nb_slots = 2 * len(panels)  # each grouping adds a panel and removes two
+		xyrb = np.zeros((nb_slots, 4), dtype = np.int64)
+		xyrb[:len(panels)] = [[p.x, p.y, p.r, p.b] for p in panels]
+		alive = np.zeros(nb_slots, dtype = bool)
+		alive[:len(panels)] = True
+		positions = {id(p): i for i, p in enumerate(panels)}
+
+		big_segments = np.zeros((nb_slots, nb_slots), dtype = bool)
+		bumps = np.zeros((nb_slots, nb_slots), dtype = np.int64)  # number of panels a pair bumps into
+		for j in range(1, len(panels)):
+			self.add_big_panels_pairs(xyrb, alive, big_segments, bumps, j)
+
+		while True:
+			groupable = alive[:, None] & alive[None, :] & ~big_segments & (bumps == 0)
+			groupable = np.argwhere(np.triu(groupable, 1))
+			if len(groupable) == 0:
+				break
 
-		Debug.add_step('Group big panels', self.get_infos())
+			p1, p2 = panels[groupable[0][0]], panels[groupable[0][1]]
+			p3 = p1.group_with(p2)
+
+			k = len(panels)
+			positions[id(p3)] = k
+			panels.append(p3)
+			xyrb[k] = [p3.x, p3.y, p3.r, p3.b]
+			alive[k] = True
+
+			# remove p1 and p2, like self.panels.remove() would (first equal panel in list)
+			removed = []
+			for p in [p1, p2]:
+				equal = Page.equal_panels(xyrb, p)
+				equal[positions[id(p)]] = True
+				equal &= alive
+				removed.append(np.argmax(equal))
+				alive[removed[-1]] = False
+
+			pairs = np.argwhere(np.triu(alive[:, None] & alive[None, :], 1))
+			pairs = pairs[pairs[:, 1] != k]
+			bumps[pairs[:, 0], pairs[:, 1]] -= Page.bumping_pairs(xyrb, pairs, removed).sum(axis = 1)
+			bumps[pairs[:, 0], pairs[:, 1]] += Page.bumping_pairs(xyrb, pairs, [k]).sum(axis = 1)
+			self.add_big_panels_pairs(xyrb, alive, big_segments, bumps, k)
+
+		self.panels = [p for p, keep in zip(panels, alive) if keep]
+
+		Debug.add_step('Group big panels', self.get_infos)
+
+	# Fill in big segments and bumps for pairs (i, j) of alive panels i < j
+	def add_big_panels_pairs(self, xyrb, alive, big_segments, bumps, j):
+		pairs = np.array([[i, j] for i in np.nonzero(alive[:j])[0]], dtype = np.int64).reshape(-1, 2)
+		if len(pairs) == 0:
+			return
+
+		boxes = Page.union_boxes(xyrb, pairs)
+
+		# are there big segments in pairs boxes? only segments longer than the smallest box diagonal / 5 can be
+		diagonals = np.sqrt((boxes[:, 2] - boxes[:, 0])**2 + (boxes[:, 3] - boxes[:, 1])**2)
+		segments = self.segment_set.subset(self.segment_set.dists > diagonals.min() / 5)
+		big = segments.dists[None, :] > diagonals[:, None] / 5
+		big &= PanelArray.boxes_overlap(boxes[:, None], segments.xyrb[None, :])
+		big_segments[pairs[:, 0], pairs[:, 1]] = big.any(axis = 1)
+
+		bumps[pairs[:, 0], pairs[:, 1]] = Page.bumping_pairs(xyrb, pairs, np.nonzero(alive)[0]).sum(axis = 1)
+
+	# Bounding boxes of pairs of panels, see Panel.group_with
+	@staticmethod
+	def union_boxes(xyrb, pairs):
+		return np.concatenate(
+			[
+				np.minimum(xyrb[pairs[:, 0], :2], xyrb[pairs[:, 1], :2]),
+				np.maximum(xyrb[pairs[:, 0], 2:], xyrb[pairs[:, 1], 2:])
+			],
+			axis = 1
+		)
+
+	# Whether each pair's bounding box bumps into each of given panels, see Panel.bumps_into,
+	# panels equal to either panel of the pair being left out
+	@staticmethod
+	def bumping_pairs(xyrb, pairs, others):
+		others = np.asarray(others, dtype = np.int64)
+		boxes = Page.union_boxes(xyrb, pairs)
+
+		left_out = PanelArray.boxes_equal(xyrb[pairs[:, 0], None], xyrb[None, others])
+		left_out |= PanelArray.boxes_equal(xyrb[pairs[:, 1], None], xyrb[None, others])
+		left_out |= (pairs[:, 0, None] == others[None, :]) | (pairs[:, 1, None] == others[None, :])
+		left_out |= PanelArray.boxes_equal(xyrb[None, others], boxes[:, None])
+
+		return ~left_out & PanelArray.boxes_overlap(boxes[:, None], xyrb[None, others])
@@ -1,13 +1,36 @@
 import math
+import operator
 import cv2 as cv
 import numpy as np
 
 from lib.segment import Segment
 from lib.debug import Debug
+from lib.panel_array import PanelArray
+
+
+# Property of a panel's edge, stored in a slot: moving the edge keeps page's panel index and caches up to date.
+# Panel.__init__ sets slots directly, so that only later moves go through the setter (panels are built by thousands).
+def edge_property(edge):
+	slot = '_' + edge
+
+	def move(panel, value):
+		old = getattr(panel, slot)
+		if old != value and panel.page is not None:
+			panel.page.panel_moved(panel, edge, old, value)
+		setattr(panel, slot, value)
+
+	return property(operator.attrgetter(slot), move)
 
 
 class Panel:
 
+	__slots__ = ['page', '_x', '_y', '_r', '_b', 'polygon', 'splittable', 'segments', 'coverage']
+
+	x = edge_property('x')  # panel's left edge
+	y = edge_property('y')  # panel's top edge
+	r = edge_property('r')  # panel's right edge
+	b = edge_property('b')  # panel's bottom edge
+
 	@staticmethod
 	def from_xyrb(page, x, y, r, b):
 		return Panel(page, xywh = [x, y, r - x, b - y])
@@ -21,10 +44,10 @@ class Panel:
 		if xywh is None:
 			xywh = cv.boundingRect(polygon)
 
-		self.x = xywh[0]  # panel's left edge
-		self.y = xywh[1]  # panel's top edge
-		self.r = self.x + xywh[2]  # panel's right edge
-		self.b = self.y + xywh[3]  # panel's bottom edge
+		self._x = xywh[0]
+		self._y = xywh[1]
+		self._r = xywh[0] + xywh[2]
+		self._b = xywh[1] + xywh[3]
 
 		self.polygon = polygon
 		self.splittable = splittable
@@ -52,13 +75,11 @@ class Panel:
 		return [self.x, self.y, self.w(), self.h()]
 
 	def __eq__(self, other):
-		return all(
-			[
-				abs(self.x - other.x) < self.wt(),
-				abs(self.y - other.y) < self.ht(),
-				abs(self.r - other.r) < self.wt(),
-				abs(self.b - other.b) < self.ht(),
-			]
+		wt = self.wt()
+		ht = self.ht()
+		return (
+			abs(self.x - other.x) < wt and abs(self.y - other.y) < ht and abs(self.r - other.r) < wt and
+			abs(self.b - other.b) < ht
 		)
 
 	def __lt__(self, other):
@@ -96,14 +117,12 @@ class Panel:
 		return f"{self.x}x{self.y}-{self.r}x{self.b}"
 
 	def __hash__(self):
-		return hash(self.__str__())
+		return hash((self.x, self.y, self.r, self.b))
 
 	def is_small(self, extra_ratio = 1):
-		return any(
-			[
-				self.w() < self.page.img_size[0] * self.page.small_panel_ratio * extra_ratio,
-				self.h() < self.page.img_size[1] * self.page.small_panel_ratio * extra_ratio,
-			]
+		return (
+			self.w() < self.page.img_size[0] * self.page.small_panel_ratio * extra_ratio or
+			self.h() < self.page.img_size[1] * self.page.small_panel_ratio * extra_ratio
 		)
 
 	def is_very_small(self):
@@ -123,16 +142,17 @@ class Panel:
 
 		return Panel(self.page, [x, y, r - x, b - y])
 
+	def apart(self, other):
+		return self.x > other.r or other.x > self.r or self.y > other.b or other.y > self.b
+
 	def overlap_area(self, other):
-		opanel = self.overlap_panel(other)
-		if opanel is None:
+		if self.apart(other):
 			return 0
 
-		return opanel.area()
+		return (min(self.r, other.r) - max(self.x, other.x)) * (min(self.b, other.b) - max(self.y, other.y))
 
 	def overlaps(self, other):
-		opanel = self.overlap_panel(other)
-		if opanel is None:
+		if self.apart(other):
 			return False
 
 		area_ratio = 0.1
@@ -141,15 +161,14 @@ class Panel:
 		if smallest_panel_area == 0:  # probably a horizontal or vertical segment
 			return True
 
-		return opanel.area() / smallest_panel_area > area_ratio
+		return self.overlap_area(other) / smallest_panel_area > area_ratio
 
 	def contains(self, other):
-		o_panel = self.overlap_panel(other)
-		if not o_panel:
+		if self.apart(other):
 			return False
 
 		# self contains other if their overlapping area is more than 50% of other's area
-		return o_panel.area() / other.area() > 0.50
+		return self.overlap_area(other) / other.area() > 0.50
 
 	def same_row(self, other):
 		above, below = sorted([self, other], key = lambda p: p.y)
@@ -180,26 +199,22 @@ class Panel:
 		return min_w == 0 or intersection_x / min_w >= 1 / 3
 
 	def find_top_panel(self):
-		all_top = list(filter(lambda p: p.b <= self.y and p.same_col(self), self.page.panels))
-		return max(all_top, key = lambda p: p.b) if all_top else None
+		return self.page.get_panel_index().last_before('b', self.y, lambda p: p.same_col(self))
 
 	def find_bottom_panel(self):
-		all_bottom = list(filter(lambda p: p.y >= self.b and p.same_col(self), self.page.panels))
-		return min(all_bottom, key = lambda p: p.y) if all_bottom else None
+		return self.page.get_panel_index().first_after('y', self.b, lambda p: p.same_col(self))
 
 	def find_all_left_panels(self):
-		return list(filter(lambda p: p.r <= self.x and p.same_row(self), self.page.panels))
+		return self.page.get_panel_index().all_before('r', self.x, lambda p: p.same_row(self))
 
 	def find_left_panel(self):
-		all_left = self.find_all_left_panels()
-		return max(all_left, key = lambda p: p.r) if all_left else None
+		return self.page.get_panel_index().last_before('r', self.x, lambda p: p.same_row(self))
 
 	def find_all_right_panels(self):
-		return list(filter(lambda p: p.x >= self.r and p.same_row(self), self.page.panels))
+		return self.page.get_panel_index().all_after('x', self.r, lambda p: p.same_row(self))
 
 	def find_right_panel(self):
-		all_right = self.find_all_right_panels()
-		return min(all_right, key = lambda p: p.x) if all_right else None
+		return self.page.get_panel_index().first_after('x', self.r, lambda p: p.same_row(self))
 
 	def find_neighbour_panel(self, d):
 		return {
@@ -236,8 +251,13 @@ class Panel:
 				possible_panels.append(Panel.from_xyrb(self.page, pp.x, pp.y, pp.r, other.b))
 
 		# don't take a merged panel that bumps into other panels on page
-		other_panels = [p for p in self.page.panels if p not in [self, other]]
-		possible_panels = list(filter(lambda p: not p.bumps_into(other_panels), possible_panels))
+		page_panels = PanelArray(self.page.panels)
+		left_out = PanelArray.boxes_equal(PanelArray.box(self), page_panels.xyrb)
+		left_out |= PanelArray.boxes_equal(PanelArray.box(other), page_panels.xyrb)
+		left_out |= np.array([p is self or p is other for p in page_panels.panels], dtype = bool)
+		other_panels = PanelArray(xyrb = page_panels.xyrb[~left_out])
+		bumps = PanelArray(possible_panels).bumps_into(other_panels)
+		possible_panels = [p for p, bump in zip(possible_panels, bumps) if not bump]
 
 		# take the largest merged panel
 		return max(possible_panels, key = lambda p: p.area()) if len(possible_panels) > 0 else self
@@ -248,31 +268,24 @@ class Panel:
 		c2x = other.x + other.w() / 2
 		c2y = other.y + other.h() / 2
 
-		return all(
-			[
-				abs(c1x - c2x) <= (self.w() + other.w()) * 0.75,
-				abs(c1y - c2y) <= (self.h() + other.h()) * 0.75,
-			]
-		)
+		return abs(c1x - c2x) <= (self.w() + other.w()) * 0.75 and abs(c1y - c2y) <= (self.h() + other.h()) * 0.75
 
 	def bumps_into(self, other_panels):
-		for other in other_panels:
-			if other == self:
-				continue
-			if self.overlaps(other):
-				return True
+		if not isinstance(other_panels, PanelArray):
+			other_panels = PanelArray(other_panels)
 
-		return False
+		return bool(PanelArray([self]).bumps_into(other_panels)[0])
 
 	def contains_segment(self, segment):
-		other = Panel.from_xyrb(None, *segment.to_xyrb())
-		return self.overlaps(other)
+		return bool(PanelArray.boxes_overlap(PanelArray.box(self), segment.to_xyrb()))
 
 	def get_segments(self):
 		if self.segments is not None:
 			return self.segments
 
-		self.segments = list(filter(lambda s: self.contains_segment(s), self.page.segments))
+		# same as filtering page segments with contains_segment(), all at once
+		segments = self.page.segment_set
+		self.segments = segments.subset(PanelArray.boxes_overlap(PanelArray.box(self), segments.xyrb))
 
 		return self.segments
 
@@ -304,7 +317,7 @@ class Panel:
 
 		# Compose modified polygon to optimise splits
 		original_polygon = np.copy(self.polygon)
-		polygon = np.ndarray(shape = (0, 1, 2), dtype = int, order = 'F')
+		polygon = []
 		intermediary_dots = []
 		extra_dots = []
 
@@ -319,7 +332,7 @@ class Panel:
 				original_polygon[j][0] = seg.center()
 				continue
 
-			polygon = np.append(polygon, [[dot1]], axis = 0)
+			polygon.append(dot1)
 
 			# Add dots on *long* edges, by projecting other polygon dots on this segment
 			add_dots = []
@@ -328,21 +341,16 @@ class Panel:
 			if seg.dist() < dots_along_lines_dist * 2:
 				continue
 
-			for k, dot3 in enumerate(original_polygon):
-				if abs(k - i) < min_hops:
-					continue
-
-				projected_dot3 = seg.projected_point(dot3)
-
-				# Segment should be able to contain projected_dot3
-				if not seg.may_contain(projected_dot3):
-					continue
-
-				# dot3 should be close to current segment − distance(dot3, projected_dot3) should be short
-				project = Segment(dot3[0], projected_dot3)
-				if project.dist_x() > max_dist_x or project.dist_y() > max_dist_y:
-					continue
+			# project all polygon dots at once, keep those that are on the segment and close to it
+			dots = original_polygon[:, 0]
+			projected_dots = seg.projected_points(dots)
+			keep = np.abs(np.arange(len(dots)) - i) >= min_hops
+			keep &= (projected_dots[:, 0] >= seg.left()) & (projected_dots[:, 0] <= seg.right())
+			keep &= (projected_dots[:, 1] >= seg.top()) & (projected_dots[:, 1] <= seg.bottom())
+			keep &= np.abs(dots[:, 0] - projected_dots[:, 0]) <= max_dist_x
+			keep &= np.abs(dots[:, 1] - projected_dots[:, 1]) <= max_dist_y
 
+			for projected_dot3 in map(tuple, projected_dots[keep].tolist()):
 				# append dot3 as intermediary dot on segment(dot1, dot2)
 				add_dots.append(projected_dot3)
 				intermediary_dots.append(projected_dot3)
@@ -363,12 +371,11 @@ class Panel:
 			add_dots.append(dot2b)
 			extra_dots.append(dot2b)
 
-			for dot in sorted(add_dots, key = lambda dot: Segment(dot1, dot).dist()):
-				polygon = np.append(polygon, [[dot]], axis = 0)
+			polygon += sorted(add_dots, key = lambda dot: Segment(dot1, dot).dist())
 
 		# Re-merge nearby dots together
-		original_polygon = np.copy(polygon)
-		polygon = np.ndarray(shape = (0, 1, 2), dtype = int, order = 'F')
+		original_polygon = np.array(polygon, dtype = int).reshape(-1, 1, 2)
+		polygon = []
 
 		for i in range(len(original_polygon)):
 			j = (i + 1) % len(original_polygon)
@@ -378,12 +385,15 @@ class Panel:
 
 			# merge nearby dots together
 			if seg.dist_x() < min_dist_between_dots_x and seg.dist_y() < min_dist_between_dots_y:
-				intermediary_dots = [dot for dot in intermediary_dots if dot not in [dot1, dot2]]
-				extra_dots = [dot for dot in extra_dots if dot not in [dot1, dot2]]
+				if Debug.debug:
+					intermediary_dots = [dot for dot in intermediary_dots if dot not in [dot1, dot2]]
+					extra_dots = [dot for dot in extra_dots if dot not in [dot1, dot2]]
 				original_polygon[j][0] = seg.center()
 				continue
 
-			polygon = np.append(polygon, [[dot1]], axis = 0)
+			polygon.append(dot1)
+
+		polygon = np.array(polygon, dtype = int).reshape(-1, 1, 2)
 
 		Debug.draw_polygon(polygon)
 		Debug.draw_dots(intermediary_dots, Debug.colours['red'])
@@ -391,16 +401,7 @@ class Panel:
 		Debug.add_image(f"Composed polygon {self} ({len(polygon)} dots, {len(intermediary_dots)} intermediary)")
 
 		# Find dots nearby one another
-		nearby_dots = []
-
-		for i in range(len(polygon) - min_hops):
-			for j in range(i + min_hops, len(polygon)):
-				dot1 = polygon[i][0]
-				dot2 = polygon[j][0]
-				seg = Segment(dot1, dot2)
-
-				if seg.dist_x() <= max_dist_x and seg.dist_y() <= max_dist_y:
-					nearby_dots.append([i, j])
+		nearby_dots = Panel.nearby_dots(polygon, max_dist_x, max_dist_y, min_hops)
 
 		if len(nearby_dots) == 0:
 			return None
@@ -409,6 +410,7 @@ class Panel:
 		Debug.add_image(f"Nearby dots ({len(nearby_dots)})")
 
 		splits = []
+		split_segments = set()  # Split equality is segment equality
 		for dots in nearby_dots:
 			poly1len = len(polygon) - dots[1] + dots[0]
 			poly2len = dots[1] - dots[0]
@@ -418,17 +420,7 @@ class Panel:
 				continue
 
 			# Construct two subpolygons by distributing the dots around our nearby dots
-			poly1 = np.zeros(shape = (poly1len, 1, 2), dtype = int)
-			poly2 = np.zeros(shape = (poly2len, 1, 2), dtype = int)
-
-			x = y = 0
-			for i in range(len(polygon)):
-				if i <= dots[0] or i > dots[1]:
-					poly1[x][0] = polygon[i]
-					x += 1
-				else:
-					poly2[y][0] = polygon[i]
-					y += 1
+			poly1, poly2 = Panel.split_polygon(polygon, dots[0], dots[1])
 
 			panel1 = Panel(self.page, polygon = poly1)
 			panel2 = Panel(self.page, polygon = poly2)
@@ -443,9 +435,11 @@ class Panel:
 				continue
 
 			split_segment = Segment.along_polygon(polygon, dots[0], dots[1])
-			split = Split(self, panel1, panel2, split_segment)
-			if split not in splits:
-				splits.append(split)
+			if split_segment.key() in split_segments:
+				continue
+
+			split_segments.add(split_segment.key())
+			splits.append(Split(self, panel1, panel2, split_segment))
 
 		Debug.draw_segments([split.segment for split in splits], Debug.colours['red'], size = 2)
 		Debug.add_image(f"Splits ({len(splits)})")
@@ -460,6 +454,36 @@ class Panel:
 
 		return best_split
 
+	# scipy's cKDTree isn't used here: detection only depends on numpy and OpenCV (scipy is only listed in
+	# lib/requirements.txt for lib/analise.py tools), and on a 504 dots polygon, distances take 2.6ms out of 19ms,
+	# the rest being the ~32k nearby pairs themselves, which a tree query would also give one by one (then sorted)
+	NEARBY_DOTS_BLOCK = 512  # rows of the pairwise distance matrix computed at once
+
+	# Pairs [i, j] of polygon dots, at least min_hops apart along the polygon, within max_dist_x and max_dist_y
+	@staticmethod
+	def nearby_dots(polygon, max_dist_x, max_dist_y, min_hops):
+		dots = polygon[:, 0]
+		nb_dots = len(dots)
+
+		nearby_dots = []
+		for start in range(0, max(nb_dots - min_hops, 0), Panel.NEARBY_DOTS_BLOCK):
+			rows = np.arange(start, min(start + Panel.NEARBY_DOTS_BLOCK, nb_dots - min_hops))
+			nearby = np.abs(dots[rows, None, 0] - dots[None, :, 0]) <= max_dist_x
+			nearby &= np.abs(dots[rows, None, 1] - dots[None, :, 1]) <= max_dist_y
+			nearby &= np.arange(nb_dots)[None, :] >= rows[:, None] + min_hops
+
+			for i, j in zip(*np.nonzero(nearby)):
+				nearby_dots.append([int(rows[i]), int(j)])
+
+		return nearby_dots
+
+	# Two subpolygons: dots up to i and after j, and dots from i (excluded) to j
+	@staticmethod
+	def split_polygon(polygon, i, j):
+		poly1 = np.concatenate([polygon[:i + 1], polygon[j + 1:]]).astype(int)
+		poly2 = polygon[i + 1:j + 1].astype(int)
+		return poly1, poly2
+
 
 class Split:
 
@@ -467,9 +491,21 @@ class Split:
 		self.panel = panel
 		self.subpanels = [subpanel1, subpanel2]
 		self.segment = split_segment
-
-		self.matching_segments = self.segment.intersect_all(self.panel.get_segments())
-		self.covered_dist = sum(map(lambda s: s.dist(), self.matching_segments))
+		self._matching_segments = None
+		self._covered_dist = None
+
+	# segments matching is computed when first needed only
+	@property
+	def matching_segments(self):
+		if self._matching_segments is None:
+			self._matching_segments = self.segment.intersect_all(self.panel.get_segments())
+		return self._matching_segments
+
+	@property
+	def covered_dist(self):
+		if self._covered_dist is None:
+			self._covered_dist = sum(map(lambda s: s.dist(), self.matching_segments))
+		return self._covered_dist
 
 	def __eq__(self, other):
 		return self.segment == other.segment
@@ -0,0 +1,168 @@
+import heapq
+import bisect
+import numpy as np
+
+
+# Panels' edges as an N×4 array of [x, y, r, b] rows, to run Panel predicates on many panels at once.
+# Predicates compare each row with a panel (or an array of [x, y, r, b] boxes, broadcast against rows),
+# and give the same results as the Panel methods of the same name, called on row panels.
+class PanelArray:
+
+	def __init__(self, panels = (), xyrb = None):
+		self.panels = list(panels)
+		if xyrb is None:
+			xyrb = [[p.x, p.y, p.r, p.b] for p in self.panels]
+		self.xyrb = np.array(xyrb, dtype = np.int32).reshape(-1, 4)
+
+	def __len__(self):
+		return len(self.xyrb)
+
+	@staticmethod
+	def box(panel):
+		return np.array([panel.x, panel.y, panel.r, panel.b], dtype = np.int64)
+
+	@staticmethod
+	def edges(xyrb):
+		xyrb = np.asarray(xyrb, dtype = np.int64)  # areas may not fit in 32 bits
+		return xyrb[..., 0], xyrb[..., 1], xyrb[..., 2], xyrb[..., 3]
+
+	def as_boxes(self, other):
+		return PanelArray.box(other) if hasattr(other, 'r') else other
+
+	def update(self, i, panel):
+		self.xyrb[i] = [panel.x, panel.y, panel.r, panel.b]
+
+	def w(self):
+		return self.xyrb[:, 2] - self.xyrb[:, 0]
+
+	def h(self):
+		return self.xyrb[:, 3] - self.xyrb[:, 1]
+
+	def area(self):
+		x, y, r, b = PanelArray.edges(self.xyrb)
+		return (r - x) * (b - y)
+
+	# rows equal to other, as in `panel == other`
+	def equal(self, other):
+		return PanelArray.boxes_equal(self.xyrb, self.as_boxes(other))
+
+	def is_small(self, page, extra_ratio = 1):
+		return (self.w() < page.img_size[0] * page.small_panel_ratio * extra_ratio) | (
+			self.h() < page.img_size[1] * page.small_panel_ratio * extra_ratio
+		)
+
+	def apart(self, other):
+		return PanelArray.boxes_apart(self.xyrb, self.as_boxes(other))
+
+	def overlap_area(self, other):
+		return PanelArray.boxes_overlap_area(self.xyrb, self.as_boxes(other))
+
+	def overlaps(self, other):
+		return PanelArray.boxes_overlap(self.xyrb, self.as_boxes(other))
+
+	def contains(self, other):
+		other = self.as_boxes(other)
+		x, y, r, b = PanelArray.edges(other)
+		with np.errstate(divide = 'ignore', invalid = 'ignore'):
+			return ~self.apart(other) & (self.overlap_area(other) / ((r - x) * (b - y)) > 0.50)
+
+	def contained_in(self, other):
+		other = self.as_boxes(other)
+		with np.errstate(divide = 'ignore', invalid = 'ignore'):
+			return ~self.apart(other) & (self.overlap_area(other) / self.area() > 0.50)
+
+	# rows that bump into other panels, see Panel.bumps_into
+	def bumps_into(self, other_panels):
+		others = other_panels.xyrb[None, :]
+		rows = self.xyrb[:, None]
+		return (~PanelArray.boxes_equal(others, rows) & PanelArray.boxes_overlap(rows, others)).any(axis = 1)
+
+	def same_row(self, other):
+		_, y, _, b = PanelArray.edges(self.as_boxes(other))
+		return PanelArray.boxes_same_span(self.xyrb[:, 1], self.xyrb[:, 3], y, b)
+
+	def same_col(self, other):
+		x, _, r, _ = PanelArray.edges(self.as_boxes(other))
+		return PanelArray.boxes_same_span(self.xyrb[:, 0], self.xyrb[:, 2], x, r)
+
+	# For each panel, sorted positions of panels that are not apart from it (itself included), see Panel.apart.
+	# Sweep line over x edges: panels are active from their x edge to their r edge, and active panels are kept
+	# sorted by y edge, so that only panels that also intersect on y are visited.
+	def intersecting(self):
+		boxes = self.xyrb.tolist()
+		neighbours = [[i] for i in range(len(boxes))]
+		expiring = []  # (r, i) of active panels
+		active = []  # (y, i) of active panels, sorted
+
+		for i in sorted(range(len(boxes)), key = lambda i: boxes[i][0]):
+			x, y, r, b = boxes[i]
+			while len(expiring) > 0 and expiring[0][0] < x:
+				_, j = heapq.heappop(expiring)
+				del active[bisect.bisect_left(active, (boxes[j][1], j))]
+
+			for _, j in active[:bisect.bisect_right(active, (b, len(boxes)))]:
+				if boxes[j][3] >= y:
+					neighbours[i].append(j)
+					neighbours[j].append(i)
+
+			heapq.heappush(expiring, (r, i))
+			bisect.insort(active, (y, i))
+
+		return list(map(sorted, neighbours))
+
+	# Vectorized predicates on arrays of [x, y, r, b] boxes broadcast against one another
+
+	@staticmethod
+	def boxes_apart(xyrb1, xyrb2):
+		x1, y1, r1, b1 = PanelArray.edges(xyrb1)
+		x2, y2, r2, b2 = PanelArray.edges(xyrb2)
+		return (x1 > r2) | (x2 > r1) | (y1 > b2) | (y2 > b1)
+
+	# overlapping area, 0 for boxes apart from one another
+	@staticmethod
+	def boxes_overlap_area(xyrb1, xyrb2):
+		x1, y1, r1, b1 = PanelArray.edges(xyrb1)
+		x2, y2, r2, b2 = PanelArray.edges(xyrb2)
+		apart = (x1 > r2) | (x2 > r1) | (y1 > b2) | (y2 > b1)
+		overlap_area = (np.minimum(r1, r2) - np.maximum(x1, x2)) * (np.minimum(b1, b2) - np.maximum(y1, y2))
+		return np.where(apart, 0, overlap_area)
+
+	@staticmethod
+	def boxes_overlap(xyrb1, xyrb2):
+		x1, y1, r1, b1 = PanelArray.edges(xyrb1)
+		x2, y2, r2, b2 = PanelArray.edges(xyrb2)
+		apart = (x1 > r2) | (x2 > r1) | (y1 > b2) | (y2 > b1)
+		overlap_area = (np.minimum(r1, r2) - np.maximum(x1, x2)) * (np.minimum(b1, b2) - np.maximum(y1, y2))
+		smallest_area = np.minimum((r1 - x1) * (b1 - y1), (r2 - x2) * (b2 - y2))
+		with np.errstate(divide = 'ignore', invalid = 'ignore'):
+			overlaps = (smallest_area == 0) | (overlap_area / smallest_area > 0.1)
+
+		return ~apart & overlaps
+
+	# with first boxes' thresholds
+	@staticmethod
+	def boxes_equal(xyrb1, xyrb2):
+		x1, y1, r1, b1 = PanelArray.edges(xyrb1)
+		x2, y2, r2, b2 = PanelArray.edges(xyrb2)
+		wt = (r1 - x1) / 10
+		ht = (b1 - y1) / 10
+		return (np.abs(x1 - x2) < wt) & (np.abs(y1 - y2) < ht) & (np.abs(r1 - r2) < wt) & (np.abs(b1 - b2) < ht)
+
+	# same_row() on y and b edges, same_col() on x and r edges
+	@staticmethod
+	def boxes_same_span(start1, end1, start2, end2):
+		start1, end1, start2, end2 = np.broadcast_arrays(
+			*[np.asarray(a, dtype = np.int64) for a in [start1, end1, start2, end2]]
+		)
+
+		# first and second boxes, sorted by start edge (first one on ties)
+		first_is_1 = start1 <= start2
+		start_a, end_a = np.where(first_is_1, start1, start2), np.where(first_is_1, end1, end2)
+		start_b, end_b = np.where(first_is_1, start2, start1), np.where(first_is_1, end2, end1)
+
+		intersection = np.minimum(end_a, end_b) - start_b
+		min_length = np.minimum(end_a - start_a, end_b - start_b)
+		with np.errstate(divide = 'ignore', invalid = 'ignore'):
+			intersect = (min_length == 0) | (intersection / min_length >= 1 / 3)
+
+		return ~(start_b > end_a) & ((end_b < end_a) | intersect)
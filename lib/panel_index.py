@@ -0,0 +1,125 @@
+import math
+import bisect
+import numpy as np
+
+EDGES = ('x', 'y', 'r', 'b')
+
+
+# Page panels list, which drops the page's panel index and caches whenever panels are added, removed or reordered
+class PanelList(list):
+
+	def __init__(self, page, panels = ()):
+		super().__init__(panels)
+		self.page = page
+
+	def changed(self):
+		page = getattr(self, 'page', None)  # not set yet while unpickling
+		if page is not None:
+			page.panels_changed()
+
+	def append(self, panel):
+		super().append(panel)
+		self.changed()
+
+	def extend(self, panels):
+		super().extend(panels)
+		self.changed()
+
+	def insert(self, i, panel):
+		super().insert(i, panel)
+		self.changed()
+
+	def remove(self, panel):
+		super().remove(panel)
+		self.changed()
+
+	def pop(self, *args):
+		panel = super().pop(*args)
+		self.changed()
+		return panel
+
+	def clear(self):
+		super().clear()
+		self.changed()
+
+	def sort(self, *args, **kwargs):
+		super().sort(*args, **kwargs)
+		self.changed()
+
+	def reverse(self):
+		super().reverse()
+		self.changed()
+
+	def __setitem__(self, i, value):
+		super().__setitem__(i, value)
+		self.changed()
+
+	def __delitem__(self, i):
+		super().__delitem__(i)
+		self.changed()
+
+	def __iadd__(self, panels):
+		super().__iadd__(panels)
+		self.changed()
+		return self
+
+
+# Panels' edges, sorted by value then position in the page's panels list, to answer neighbour queries.
+# Results are the same as filtering the whole panels list: in case of ties, the first panel in the list wins.
+# Only finding where coord falls takes log time: panels that don't match are then skipped one by one,
+# and all_before / all_after filter edges' values in list order, which is linear (but vectorized).
+class PanelIndex:
+
+	def __init__(self, panels):
+		self.panels = list(panels)
+		self.positions = {id(p): i for i, p in enumerate(self.panels)}
+		self.edges = {}
+		self.values = {}  # edges' values in panels list order
+		for edge in EDGES:
+			self.edges[edge] = sorted((getattr(p, edge), i) for i, p in enumerate(self.panels))
+			self.values[edge] = np.array([getattr(p, edge) for p in self.panels], dtype = np.float64)
+
+	# keep index up to date when a panel edge is moved
+	def move(self, panel, edge, old, new):
+		i = self.positions.get(id(panel))
+		if i is None:
+			return
+
+		entries = self.edges[edge]
+		del entries[bisect.bisect_left(entries, (old, i))]
+		bisect.insort(entries, (new, i))
+		self.values[edge][i] = new
+
+	# panel with the biggest edge value <= coord, that matches
+	def last_before(self, edge, coord, match):
+		entries = self.edges[edge]
+		k = bisect.bisect_right(entries, (coord, math.inf)) - 1
+
+		best = best_value = None
+		while k >= 0:
+			value, i = entries[k]
+			if best is not None and value != best_value:
+				break
+			if match(self.panels[i]):
+				best, best_value = i, value  # positions decrease, in a group of equal values
+			k -= 1
+
+		return self.panels[best] if best is not None else None
+
+	# panel with the smallest edge value >= coord, that matches
+	def first_after(self, edge, coord, match):
+		entries = self.edges[edge]
+		for k in range(bisect.bisect_left(entries, (coord, -1)), len(entries)):
+			i = entries[k][1]
+			if match(self.panels[i]):
+				return self.panels[i]
+
+		return None
+
+	# all panels with edge value <= coord that match, in panels list order
+	def all_before(self, edge, coord, match):
+		return [self.panels[i] for i in np.flatnonzero(self.values[edge] <= coord) if match(self.panels[i])]
+
+	# all panels with edge value >= coord that match, in panels list order
+	def all_after(self, edge, coord, match):
+		return [self.panels[i] for i in np.flatnonzero(self.values[edge] >= coord) if match(self.panels[i])]
@@ -0,0 +1,99 @@
+import os
+import re
+import sys
+import time
+import collections
+import cv2 as cv
+from concurrent.futures import ThreadPoolExecutor
+
+from lib.page import Page
+
+
+# Export of pages' panels as image files, run along panels detection: as soon as a page is added, its image is
+# decoded and its panels are cut out and encoded by a pool of threads (OpenCV releases the GIL while doing so).
+class PanelsExport:
+
+	FORMATS = ['jpg', 'png', 'webp']
+
+	# quality option of each format: JPEG and WebP quality (0-100), PNG compression level (0-9)
+	QUALITY_PARAMS = {
+		'jpg': cv.IMWRITE_JPEG_QUALITY,
+		'png': cv.IMWRITE_PNG_COMPRESSION,
+		'webp': cv.IMWRITE_WEBP_QUALITY,
+	}
+
+	def __init__(self, output_base_path, output_format = 'jpg', quality = None, threads = None):
+		if output_format not in PanelsExport.FORMATS:
+			raise ValueError(f"Unknown panels format: {output_format}")
+
+		self.output_base_path = output_base_path
+		self.output_format = output_format
+		self.params = [] if quality is None else [PanelsExport.QUALITY_PARAMS[output_format], quality]
+
+		self.threads = threads or os.cpu_count() or 1
+		self.executor = ThreadPoolExecutor(max_workers = self.threads)
+		self.pending = collections.deque()
+
+		# stats, in seconds: decode and encode times add up over all threads
+		self.nb_written_panels = 0
+		self.detection_time = 0
+		self.decode_time = 0
+		self.encode_time = 0
+		self.wait_time = 0  # time spent waiting for threads, rather than detecting panels
+
+	def add(self, page):
+		output_path = os.path.join(self.output_base_path, *PanelsExport.page_path(page))
+		panels = list(map(lambda p: p.to_xywh(), page.panels))
+		source = {'file_bytes': page.file_bytes, 'pdf_page': page.pdf_page}
+		self.pending.append(
+			self.executor.submit(self.save_page_panels, page.filename, source, page.img, output_path, panels)
+		)
+		self.detection_time += page.processing_time or 0
+
+		# bounded number of pages waiting for their panels to be saved, not to hold as many images in memory
+		if len(self.pending) > 2 * self.threads:
+			self.collect()
+
+	# Path of the directory of page's panels, relative to output_base_path: pages of archives are named by their path
+	# in the archive, so that pages with the same file name in different folders do not overwrite each other's panels
+	@staticmethod
+	def page_path(page):
+		parts = re.split(r'[\\/]', page.name) if page.name else []
+		return list(filter(lambda part: part not in ['', '.', '..'], parts)) or [os.path.basename(page.filename)]
+
+	def collect(self):
+		t1 = time.perf_counter()
+		nb_written_panels, decode_time, encode_time = self.pending.popleft().result()
+		self.wait_time += time.perf_counter() - t1
+
+		self.nb_written_panels += nb_written_panels
+		self.decode_time += decode_time
+		self.encode_time += encode_time
+
+	# Wait for all panels to be saved
+	def close(self):
+		while len(self.pending) > 0:
+			self.collect()
+		self.executor.shutdown()
+
+	def save_page_panels(self, filename, source, img, output_path, panels):
+		t1 = time.perf_counter()
+		if img is None:
+			img = Page.read_img(filename, **source)
+		t2 = time.perf_counter()
+
+		os.makedirs(output_path, exist_ok = True)
+
+		nb_written_panels = 0
+		for i, (x, y, width, height) in enumerate(panels):
+			output_file = os.path.join(output_path, f"panel_{i}.{self.output_format}")
+			ok, buffer = cv.imencode('.' + self.output_format, img[y:y + height, x:x + width], self.params)
+			try:
+				if not ok:
+					raise OSError
+				buffer.tofile(output_file)  # handles file names with special characters, unlike cv.imwrite
+				nb_written_panels += 1
+			except OSError:
+				print(f"\n[ERROR] Failed to write panel image to {output_file}\n", file = sys.stderr)
+
+		return nb_written_panels, t2 - t1, time.perf_counter() - t2
@@ -0,0 +1,115 @@
+import re
+import hashlib
+import threading
+import cv2 as cv
+import numpy as np
+import pymupdf  # PyMuPDF
+
+
+# A page of a PDF file, rendered in memory at given resolution, instead of an image file.
+# Documents are opened once per process, and rendered by one thread at a time as MuPDF is not thread-safe.
+class PdfPage:
+
+	DEFAULT_DPI = 150
+
+	documents = {}
+	lock = threading.Lock()
+
+	def __init__(self, filename, number, dpi = None, document_hash = None):
+		self.filename = filename
+		self.number = number
+		self.dpi = dpi or PdfPage.DEFAULT_DPI
+		self.document_hash = document_hash or PdfPage.hash(filename)
+
+	@staticmethod
+	def hash(filename):
+		sha = hashlib.sha256()
+		with open(filename, 'rb') as fh:
+			for chunk in iter(lambda: fh.read(1024 * 1024), b''):
+				sha.update(chunk)
+		return sha.hexdigest()
+
+	@staticmethod
+	def pages(filename, dpi = None):
+		document_hash = PdfPage.hash(filename)
+		with PdfPage.lock:
+			nb_pages = len(PdfPage.document(filename))
+		return list(map(lambda number: PdfPage(filename, number, dpi, document_hash), range(nb_pages)))
+
+	@staticmethod
+	def document(filename):
+		if filename not in PdfPage.documents:
+			PdfPage.documents[filename] = pymupdf.open(filename)
+		return PdfPage.documents[filename]
+
+	# Page's image file contents, straight from the PDF file, for pages that only show one JPEG image over the whole page,
+	# as scanned comics usually do: no need to render those pages, nor to decode images at another resolution.
+	# None for other pages, e.g. with text or vector drawings, which are to be rendered.
+	def embedded_image(self):
+		with PdfPage.lock:
+			document = PdfPage.document(self.filename)
+			page = document[self.number]
+
+			images = page.get_images(full = True)
+			if page.rotation != 0 or len(images) != 1:
+				return None
+			xref, smask, image_filter = images[0][0], images[0][1], images[0][8]
+			if smask != 0 or image_filter != 'DCTDecode':
+				return None
+
+			# drawn over the whole page, with nothing else visible (OCR text layers of scans are invisible)
+			drawn = list(filter(lambda item: item[0] != 'ignore-text', page.get_bboxlog()))
+			if len(drawn) != 1 or drawn[0][0] != 'fill-image' or images[0][9] != 0:  # not in a form XObject
+				return None
+			bbox = pymupdf.Rect(drawn[0][1])
+			if abs(bbox & page.rect) < 0.99 * abs(bbox | page.rect):
+				return None
+
+			if not PdfPage.upright(page.read_contents()):
+				return None
+
+			image = document.extract_image(xref)
+
+		# CMYK JPEG images are rendered, to get their colours right
+		if image['ext'] != 'jpeg' or image['colorspace'] not in [1, 3]:
+			return None
+		return image['image']
+
+	# Whether transformations in given page contents keep images upright, without rotation nor flip, e.g. "w 0 0 h x y cm"
+	@staticmethod
+	def upright(contents):
+		for matrix in re.findall(rb'(\S+)\s+(\S+)\s+(\S+)\s+(\S+)\s+\S+\s+\S+\s+cm\b', contents):
+			try:
+				a, b, c, d = map(float, matrix)
+			except ValueError:
+				return False
+			if b != 0 or c != 0 or a <= 0 or d <= 0:
+				return False
+
+		return True
+
+	# stands for file contents in cache keys
+	def cache_key(self):
+		return f"pdf:{self.document_hash}:{self.number}:{self.dpi}".encode()
+
+	def matrix(self, scale = 1):
+		zoom = self.dpi / 72 * scale
+		return pymupdf.Matrix(zoom, zoom)
+
+	# [width,height] of the page rendered at full resolution
+	def size(self):
+		with PdfPage.lock:
+			rect = PdfPage.document(self.filename)[self.number].rect * self.matrix()
+		return [rect.irect.width, rect.irect.height]
+
+	# Page pixels, in BGR colours, or in shades of gray, possibly rendered at a lower resolution
+	def render(self, flags = cv.IMREAD_COLOR, scale = 1):
+		gray = flags == cv.IMREAD_GRAYSCALE
+		with PdfPage.lock:
+			pixmap = PdfPage.document(self.filename)[self.number].get_pixmap(
+				matrix = self.matrix(scale), colorspace = pymupdf.csGRAY if gray else pymupdf.csRGB, alpha = False
+			)
+
+		img = np.frombuffer(pixmap.samples, dtype = np.uint8).reshape(pixmap.h, pixmap.stride)
+		img = img[:, :pixmap.w * pixmap.n].reshape(pixmap.h, pixmap.w, pixmap.n)
+		return img[:, :, 0].copy() if gray else cv.cvtColor(img, cv.COLOR_RGB2BGR)
@@ -126,13 +126,10 @@ class Segment:
 		return math.atan(self.dist_y() / self.dist_x()) if self.dist_x() != 0 else math.pi / 2
 
 	def intersect_all(self, segments):
-		segments_match = []
-		for segment in segments:
-			s3 = self.intersect(segment)
-			if s3 is not None:
-				segments_match.append(s3)
+		if not isinstance(segments, SegmentSet):
+			segments = SegmentSet(segments)
 
-		return Segment.union_all(segments_match)
+		return segments.intersect_all(self)
 
 	@staticmethod
 	def along_polygon(polygon, i, j):
@@ -158,33 +155,103 @@ class Segment:
 
 		return split_segment
 
+	# key identifying equal segments (see __eq__), whatever their direction
+	def key(self):
+		return (self.a, self.b) if self.a <= self.b else (self.b, self.a)
+
 	@staticmethod
 	def union_all(segments):
 		unioned_segments = True
 		while unioned_segments:
 			unioned_segments = False
 			dedup_segments = []
-			used = []
+			used = set()
+			candidates = Segment.union_candidates(segments)
 			for i, s1 in enumerate(segments):
-				for s2 in segments[i + 1:]:
-					if s2 in used:
+				for j in candidates[i]:
+					s2 = segments[j]
+					if s2.key() in used:
 						continue
 
 					s3 = s1.union(s2)
 					if s3 is not None:
 						unioned_segments = True
 						dedup_segments += [s3]
-						used.append(s1)
-						used.append(s2)
+						used.add(s1.key())
+						used.add(s2.key())
 						break
 
-				if s1 not in used:
+				if s1.key() not in used:
 					dedup_segments += [s1]
 
 			segments = dedup_segments
 
 		return dedup_segments
 
+	UNION_BUCKET_ANGLE = 10  # same as angle_ok_with's tolerance, so only adjacent buckets may hold unionable segments
+	UNION_MIN_SEGMENTS = 32  # under this, just try all pairs
+
+	# For each segment, sorted indexes of the following segments it might be unioned with.
+	# Segments are bucketed by angle, and sorted in each bucket along the axis they spread the least on,
+	# so that only segments with close angles and bounding boxes are returned (union() does the actual check).
+	@staticmethod
+	def union_candidates(segments):
+		n = len(segments)
+		if n < Segment.UNION_MIN_SEGMENTS:
+			return [range(i + 1, n) for i in range(n)]
+
+		# bounding boxes expanded by intersect()'s gutter (+1px margin against float rounding)
+		margins = np.array([s.dist() for s in segments]) * 5 / 100 + 1
+		boxes = np.array([s.to_xyrb() for s in segments], dtype = float)
+		boxes += margins[:, None] * [-1, -1, 1, 1]
+
+		angles = np.degrees([s.angle() for s in segments])
+		buckets = (angles // Segment.UNION_BUCKET_ANGLE).astype(int)
+
+		index = {}
+		for b in np.unique(buckets).tolist():
+			idx = np.flatnonzero(buckets == b)
+			extents = boxes[idx, 2:] - boxes[idx, :2]
+			max_extents = extents.max(axis = 0)
+			axis = 0 if max_extents[0] <= max_extents[1] else 1
+
+			order = np.argsort(boxes[idx, axis], kind = 'stable')
+			index[b] = (idx[order], boxes[idx[order], axis], max_extents[axis], axis)
+
+		candidates = []
+		for i in range(n):
+			box = boxes[i]
+			found = []
+			for b in range(buckets[i] - 1, buckets[i] + 2):
+				if b not in index:
+					continue
+
+				idx, starts, max_extent, axis = index[b]
+				lo = np.searchsorted(starts, box[axis] - max_extent, side = 'left')
+				hi = np.searchsorted(starts, box[axis + 2], side = 'right')
+				found.append(idx[lo:hi])
+
+			found = np.concatenate(found)
+			found = found[found > i]
+			found = found[(boxes[found, 0] <= box[2]) & (boxes[found, 2] >= box[0]) & (boxes[found, 1] <= box[3]) &
+							(boxes[found, 3] >= box[1])]
+			found = found[np.abs(angles[found] - angles[i]) < Segment.UNION_BUCKET_ANGLE + 1e-6]
+
+			candidates.append(np.sort(found).tolist())
+
+		return candidates
+
+	# Vectorized projected_point(), for an array of N points: returns an N×2 int array
+	def projected_points(self, points):
+		a = np.array(self.a)
+		ab = np.array(self.b) - a
+		points = np.asarray(points).reshape(-1, 2)
+		if ab[0] == 0 and ab[1] == 0:
+			return np.tile(a, (len(points), 1))
+
+		ratios = ((points - a) * ab).sum(axis = 1) / np.dot(ab, ab)
+		return np.rint(a + ratios[:, None] * ab).astype(int)
+
 	def projected_point(self, p):
 		a = np.array(self.a)
 		b = np.array(self.b)
@@ -195,3 +262,78 @@ class Segment:
 			return a
 		result = a + np.dot(ap, ab) / np.dot(ab, ab) * ab
 		return (round(result[0]), round(result[1]))
+
+
+# Structure-of-arrays view on a list of segments (endpoints, bounding boxes, lengths and angles),
+# to check many segments against one in a single NumPy call
+class SegmentSet:
+
+	def __init__(self, segments):
+		self.segments = list(segments)
+
+		self.a = np.array([s.a for s in self.segments], dtype = np.int64).reshape(-1, 2)
+		self.b = np.array([s.b for s in self.segments], dtype = np.int64).reshape(-1, 2)
+		self.xyrb = np.concatenate([np.minimum(self.a, self.b), np.maximum(self.a, self.b)], axis = 1)
+
+		self.dists = np.sqrt(((self.b - self.a)**2).sum(axis = 1))
+		# computed one by one, to get the exact same values as Segment.angle()
+		self.angles = np.array([s.angle() for s in self.segments], dtype = float)
+
+	def __len__(self):
+		return len(self.segments)
+
+	def __iter__(self):
+		return iter(self.segments)
+
+	def subset(self, mask):
+		subset = SegmentSet.__new__(SegmentSet)
+		subset.segments = [s for s, keep in zip(self.segments, mask) if keep]
+		subset.a = self.a[mask]
+		subset.b = self.b[mask]
+		subset.xyrb = self.xyrb[mask]
+		subset.dists = self.dists[mask]
+		subset.angles = self.angles[mask]
+		return subset
+
+	# same as [s.angle_ok_with(segment) for s in self]
+	def angle_ok_with(self, segment):
+		angles = np.degrees(np.abs(self.angles - segment.angle()))
+		return (angles < 10) | (np.abs(angles - 180) < 10)
+
+	# mask of segments whose bounding box is not apart from given box by more than gutter (scalar or array)
+	def in_box(self, x, y, r, b, gutter = 0):
+		return ~(
+			(r < self.xyrb[:, 0] - gutter) | (x > self.xyrb[:, 2] + gutter) | (b < self.xyrb[:, 1] - gutter) |
+			(y > self.xyrb[:, 3] + gutter)
+		)
+
+	# same as [segment.intersect(s) for s in self], without the None results
+	def intersections(self, segment):
+		if len(self) == 0:
+			return []
+
+		gutter = np.maximum(segment.dist(), self.dists) * 5 / 100
+
+		mask = self.angle_ok_with(segment) & self.in_box(*segment.to_xyrb(), gutter = gutter)
+		candidates = np.flatnonzero(mask)
+		if len(candidates) == 0:
+			return []
+
+		# segments are a bit too far from each other
+		projected_c = segment.projected_points(self.a[candidates])
+		projected_d = segment.projected_points(self.b[candidates])
+		dist_c_to_ab = np.sqrt(((self.a[candidates] - projected_c)**2).sum(axis = 1))
+		dist_d_to_ab = np.sqrt(((self.b[candidates] - projected_d)**2).sum(axis = 1))
+		candidates = candidates[(dist_c_to_ab + dist_d_to_ab) / 2 <= gutter[candidates]]
+
+		intersections = []
+		for i in candidates.tolist():
+			other = self.segments[i]
+			sorted_dots = sorted([segment.a, segment.b, other.a, other.b], key = sum)
+			b, c = sorted_dots[1:3]
+			intersections.append(Segment(b, c))
+
+		return intersections
+
+	def intersect_all(self, segment):
+		return Segment.union_all(self.intersections(segment))
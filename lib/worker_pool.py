@@ -0,0 +1,127 @@
+import time
+import threading
+import collections
+import numpy as np
+from concurrent import futures
+from concurrent.futures import ProcessPoolExecutor
+
+
+class QueueFullException(Exception):
+	pass
+
+
+# Pool of worker processes, all started and warmed up beforehand, that accepts a bounded number of tasks:
+# as many as there are workers, plus queue_size waiting ones.
+# Background tasks (e.g. jobs' pages) hold at most `background_slots` of these at once, the other ones are left
+# to interactive requests.
+# Tasks' outcomes and latencies are counted, for metrics, separately for interactive and background tasks.
+class WorkerPool:
+
+	LATENCIES = 1000  # number of latest latencies that percentiles are computed on
+	KINDS = ['interactive', 'background']
+
+	def __init__(self, workers, queue_size, background_slots = None, initializer = None, warm_up = None):
+		self.workers = workers
+		self.queue_size = queue_size
+		self.background_slots = background_slots or max(1, workers // 2)
+		self.executor = ProcessPoolExecutor(max_workers = workers, initializer = initializer)
+
+		self.slots = threading.BoundedSemaphore(workers + queue_size)
+		self.background = threading.BoundedSemaphore(self.background_slots)
+		self.lock = threading.Lock()
+		self.nb_tasks = 0  # accepted tasks, not done yet
+		self.outcomes = {kind: collections.Counter() for kind in WorkerPool.KINDS}
+		self.latencies = {kind: collections.deque(maxlen = WorkerPool.LATENCIES) for kind in WorkerPool.KINDS}
+
+		# each submitted task starts a new process, until there are as many as workers
+		if warm_up:
+			for future in [self.executor.submit(warm_up) for _ in range(workers)]:
+				future.result()
+
+	# Future result of fn(*args): raises QueueFullException if too many tasks are waiting already,
+	# unless `block` is set, to wait for a task to be done instead
+	def submit(self, fn, *args, block = False):
+		if not self.slots.acquire(blocking = block):
+			self.count('interactive', 'rejected')
+			raise QueueFullException(f"{self.workers + self.queue_size} tasks are already running or waiting")
+
+		with self.lock:
+			self.nb_tasks += 1
+		future = self.executor.submit(fn, *args)
+		future.add_done_callback(self.task_done)
+		return future
+
+	def task_done(self, future):
+		with self.lock:
+			self.nb_tasks -= 1
+		self.slots.release()
+
+	# Future result of fn(*args), once one of the background slots, then one of the pool's slots, are free
+	def submit_background(self, fn, *args):
+		t1 = time.perf_counter()
+		self.background.acquire()
+		try:
+			future = self.submit(fn, *args, block = True)
+		except BaseException:
+			self.background.release()
+			raise
+
+		future.add_done_callback(lambda future: self.background_task_done(future, t1))
+		return future
+
+	def background_task_done(self, future, t1):
+		self.background.release()
+		if future.cancelled():
+			outcome = 'cancelled'
+		else:
+			outcome = 'ok' if future.exception() is None else 'error'
+		self.count('background', outcome, time.perf_counter() - t1)
+
+	# Result of fn(*args), run by a worker: raises QueueFullException if too many tasks are waiting already,
+	# and futures.TimeoutError if it takes longer than timeout seconds
+	# (the task keeps its worker busy until done though)
+	def run(self, fn, *args, timeout = None):
+		t1 = time.perf_counter()
+		future = self.submit(fn, *args)
+
+		outcome = 'error'
+		try:
+			result = future.result(timeout = timeout)
+			outcome = 'ok'
+			return result
+		except futures.TimeoutError:  # not the builtin TimeoutError before Python 3.11
+			future.cancel()
+			outcome = 'timeout'
+			raise
+		finally:
+			self.count('interactive', outcome, time.perf_counter() - t1)
+
+	def count(self, kind, outcome, latency = None):
+		with self.lock:
+			self.outcomes[kind][outcome] += 1
+			if latency is not None:
+				self.latencies[kind].append(latency)
+
+	def metrics(self):
+		with self.lock:
+			nb_tasks = self.nb_tasks
+			outcomes = {kind: dict(self.outcomes[kind]) for kind in WorkerPool.KINDS}
+			latencies = {kind: list(self.latencies[kind]) for kind in WorkerPool.KINDS}
+
+		percentiles = [50, 90, 99]
+		names = list(map(lambda p: f"p{p}", percentiles))
+		nones = [None] * len(percentiles)
+		values = lambda latencies: np.percentile(latencies, percentiles).tolist() if latencies else nones
+
+		return {
+			'workers': self.workers,
+			'queue_size': self.queue_size,
+			'background_slots': self.background_slots,
+			'queue_depth': max(0, nb_tasks - self.workers),
+			'running': min(nb_tasks, self.workers),
+			'tasks': outcomes,
+			'latency_seconds': {kind: dict(zip(names, values(latencies[kind]))) for kind in WorkerPool.KINDS},
+		}
+
+	def shutdown(self):
+		self.executor.shutdown(cancel_futures = True)
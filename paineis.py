@@ -1,14 +1,33 @@
 import os
 import sys
 import json
+import itertools
 import cv2 as cv
 import fitz  # PyMuPDF
 from PIL import Image
 from ebooklib import epub
 
-def recortar_paineis_json(json_path, images_folder, output_base_path='saida', output_format='jpg'): # Segmenta um quadrinho a partir de um arquivo .json
+def carregar_paginas_json(json_path): # Lê as páginas de um arquivo .json (lista de páginas) ou .ndjson (uma página por linha, "-" para a entrada padrão)
+    f = sys.stdin if json_path == '-' else open(json_path, 'r', encoding='utf-8')
+    try:
+        primeira_linha = f.readline()
+        while primeira_linha and not primeira_linha.strip(): # Ignora linhas em branco no início do arquivo
+            primeira_linha = f.readline()
+
+        if primeira_linha.lstrip().startswith('['):
+            yield from json.loads(primeira_linha + f.read())
+            return
+
+        for linha in itertools.chain([primeira_linha], f):
+            if linha.strip():
+                yield json.loads(linha)
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+def recortar_paineis_json(json_path, images_folder, output_base_path='saida', output_format='jpg'): # Segmenta um quadrinho a partir de um arquivo .json ou .ndjson
     # Verificações iniciais
-    if not os.path.exists(json_path):
+    if json_path != '-' and not os.path.exists(json_path):
         print(f"[ERROR] JSON file not found: {json_path}", file=sys.stderr)
         sys.exit(1)
 
@@ -18,13 +37,10 @@ def recortar_paineis_json(json_path, images_folder, output_base_path='saida', ou
 
     os.makedirs(output_base_path, exist_ok=True)
 
-    # Carrega os dados do JSON
-    with open(json_path, 'r', encoding='utf-8') as f:
-        data = json.load(f)
-
     nb_written_panels = 0
 
-    for page in data:
+    # Páginas do JSON, lidas conforme chegam no caso de NDJSON
+    for page in carregar_paginas_json(json_path):
         filename = page.get("filename")
         panels = page.get("panels", [])
         image_path = os.path.join(images_folder, filename)
@@ -124,7 +124,8 @@ class Reader {
 				height: imginfo.size[1],
 				padding: '2em',
 			});
-		var imgurl = this.images_dir == 'urls' ? imginfo.filename : this.images_dir + imginfo.filename.split('/').reverse()[0];
+		// page names are file names, or paths within comic book archives
+		var imgurl = this.images_dir == 'urls' ? imginfo.filename : this.images_dir + imginfo.filename;
 		
 		var img = $('<img class="pageimg" src="'+imgurl+'"/>');
 		img.css({
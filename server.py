@@ -1,10 +1,21 @@
 #!/usr/bin/env python3
 
 import os
+import sys
 import json
-from bottle import route, run, request, static_file, abort
-from kumikolib import Kumiko
+import signal
+import argparse
+from concurrent import futures
+from socketserver import ThreadingMixIn
+from wsgiref.simple_server import WSGIServer
+from bottle import route, run, request, response, static_file, abort, HTTPError, HTTPResponse
+from kumikolib import Kumiko, init_worker, warm_up_worker, url_page_infos
 from lib.html import HTML
+from lib.page import NotAnImageException
+from lib.archive import Archive
+from lib.download import DownloadException
+from lib.worker_pool import WorkerPool, QueueFullException
+from lib.jobs import Jobs
 
 static_files = {
 	'jquery-3.2.1.min.js': True,
@@ -12,6 +23,30 @@ static_files = {
 	'style.css': True,
 }
 
+# set up in main
+pool = None
+jobs = None
+page_options = None
+timeout = None
+
+
+# One thread per request, requests only wait on the worker pool
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+	daemon_threads = True
+
+
+def page_infos(url):
+	try:
+		return pool.run(url_page_infos, url, dict(page_options, url = url), timeout = timeout)
+	except QueueFullException:
+		raise HTTPError(429, "Too many requests, try again later", **{'Retry-After': '1'})
+	except futures.TimeoutError:
+		raise HTTPError(504, f"Processing took longer than {timeout} seconds")
+	except DownloadException as e:
+		raise HTTPError(502, f"Could not download {url}: {e}")
+	except NotAnImageException:
+		raise HTTPError(422, f"Not an image: {url}")
+
 
 @route('/html', method = 'GET')
 def html():
@@ -20,10 +55,7 @@ def html():
 	if ext.lower() not in ('.png', '.jpg', '.jpeg'):
 		return "File extension not allowed."
 
-	k = Kumiko()
-	k.parse_url_list([url])
-
-	infos = json.dumps(k.get_infos())
+	infos = json.dumps([page_infos(url)])
 
 	return f"""
 		{HTML.header(reldir = '/static/')}
@@ -32,6 +64,62 @@ def html():
 		"""
 
 
+@route('/metrics', method = 'GET')
+def metrics():
+	response.content_type = 'application/json'
+	return json.dumps(dict(pool.metrics(), jobs = jobs.counts()))
+
+
+# New job processing pages of a JSON list of image URLs, {"urls": [...]}, or of an uploaded comic book archive,
+# a "file" form field: pages' infos are then given by /jobs/<id>, or streamed as NDJSON by /jobs/<id>/pages
+@route('/jobs', method = 'POST')
+def new_job():
+	if request.json is not None:
+		urls = request.json.get('urls') if isinstance(request.json, dict) else None
+		if not isinstance(urls, list) or not all(map(lambda url: isinstance(url, str), urls)):
+			abort(400, "Expected a list of image URLs: {\"urls\": [...]}")
+		filenames = urls
+		tasks = map(lambda url: (url, dict(page_options, url = url)), urls)
+	elif request.files.get('file'):
+		try:
+			archive = Archive(request.files.get('file').file)
+		except ValueError:
+			abort(400, "Expected a CBZ or CBR file")
+		filenames = archive.entries
+		files_bytes = archive.read_entries()
+		tasks = map(lambda entry, b: (entry, dict(page_options, name = entry), b), archive.entries, files_bytes)
+	else:
+		abort(400, "Expected a list of image URLs, or a comic book archive")
+
+	job = jobs.add(pool, url_page_infos, filenames, tasks)
+	if job is None:
+		raise HTTPError(429, "Too many running jobs, try again later", **{'Retry-After': '10'})
+
+	job_url = f"/jobs/{job.id}"
+	body = json.dumps({'id': job.id, 'status_url': job_url, 'pages_url': f"{job_url}/pages"})
+	return HTTPResponse(body, status = 202, Location = job_url, **{'Content-Type': 'application/json'})
+
+
+def get_job(job_id):
+	job = jobs.get(job_id)
+	if job is None:
+		abort(404, "No such job")
+	return job
+
+
+@route('/jobs/<job_id>', method = 'GET')
+def job_status(job_id):
+	response.content_type = 'application/json'
+	return json.dumps(get_job(job_id).status())
+
+
+@route('/jobs/<job_id>/pages', method = 'GET')
+def job_pages(job_id):
+	job = get_job(job_id)
+	response.content_type = 'application/x-ndjson'
+	return map(lambda infos: json.dumps(infos) + "\n", job.pages())
+
+
 @route('/static/<filename>', method = 'GET')
 def static(filename):
 	if filename not in static_files:
@@ -40,4 +128,58 @@ def static(filename):
 	return static_file(filename, root = './')
 
 
-run(host = '127.0.0.1', port = 8091)
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description = 'Kumiko server')
+
+	parser.add_argument('--host', default = '127.0.0.1')
+	parser.add_argument('--port', type = int, default = 8091)
+	parser.add_argument(
+		'--workers',
+		type = int,
+		default = os.cpu_count() or 1,
+		help = "Number of worker processes detecting panels (default: one per CPU core)"
+	)
+	parser.add_argument(
+		'--queue-size',
+		type = int,
+		default = 16,
+		help = "Number of requests waiting for a worker, further ones are answered with 429 Too Many Requests"
+	)
+	parser.add_argument(
+		'--timeout',
+		type = float,
+		default = 30,
+		help = "Seconds a request may take, including waiting for a worker, before being answered with 504"
+	)
+	parser.add_argument(
+		'--job-workers',
+		type = int,
+		help = "Number of worker and queue slots that jobs may take at once (default: half the workers)"
+	)
+	parser.add_argument(
+		'--max-jobs',
+		type = int,
+		default = 4,
+		help = "Number of jobs running at once, further ones are answered with 429 Too Many Requests"
+	)
+
+	args = parser.parse_args()
+
+	page_options = Kumiko().page_options()
+	timeout = args.timeout
+	pool = WorkerPool(
+		args.workers,
+		args.queue_size,
+		background_slots = args.job_workers,
+		initializer = init_worker,
+		warm_up = warm_up_worker
+	)
+	jobs = Jobs(args.max_jobs)
+
+	# stopping the server (e.g. by a process manager) stops worker processes too, instead of leaving them orphaned
+	signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+	try:
+		run(host = args.host, port = args.port, server_class = ThreadingWSGIServer)
+	finally:
+		pool.shutdown()
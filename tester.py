@@ -69,7 +69,11 @@ class Tester:
 				os.makedirs(os.path.join(self.savedir, git_version), exist_ok = True)
 				jsonfile = os.path.join(self.savedir, git_version, os.path.basename(f) + '.json')
 
-				subprocess.run(args = [kumiko_bin, '-i', f, '-o', jsonfile, '--progress'], check = True)
+				kumiko_args = [kumiko_bin, '-i', f, '-o', jsonfile, '--progress']
+				if git_version == 'current':
+					kumiko_args.append('--no-cache')  # make sure current code is run, not older cached results
+
+				subprocess.run(args = kumiko_args, check = True)
 
 			return time.time() - t1
 
@@ -3,7 +3,20 @@ import subprocess
 import json
 import re
 import os
+import time
+import socket
+import urllib.request
+import urllib.error
+import zipfile
+import cv2 as cv
+import numpy as np
+import threading
+import functools
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
 from tests.base import BaseTest
+from lib.cache import Cache
+from lib.page import Page
+from lib.panel import Panel
 
 
 class TestKumiko(BaseTest):
@@ -19,15 +32,416 @@ class TestKumiko(BaseTest):
 	]
 
 	def test_simple_run(self):
-		res = subprocess.run(['./kumiko', '-i', self.simple_image], capture_output = True)
+		res = subprocess.run(['./kumiko', '-i', self.simple_image, '--no-cache'], capture_output = True)
 		out = json.loads(res.stdout)
 		panels = out[0].get("panels", [])
 
 		self.assertPanelsEqual(panels, self.simple_image_panels)
 
+	def test_parallel_run(self):
+		folder = './tests/images/005-panels-without-frame'
+		res = subprocess.run(['./kumiko', '-i', folder, '--no-cache'], capture_output = True)
+		res_parallel = subprocess.run(['./kumiko', '-i', folder, '--no-cache', '--jobs', '2'], capture_output = True)
+
+		out = json.loads(res.stdout)
+		out_parallel = json.loads(res_parallel.stdout)
+
+		self.assertEqual(list(map(lambda p: p['filename'], out)), list(map(lambda p: p['filename'], out_parallel)))
+		for page, page_parallel in zip(out, out_parallel):
+			self.assertPanelsEqual(page['panels'], page_parallel['panels'])
+
+	def test_detection_scale_run(self):
+		half = ['--detection-scale', '0.5']
+		out, out_half = [], []
+		for folder in sorted(os.listdir('./tests/images')):
+			folder = os.path.join('./tests/images', folder)
+			res = subprocess.run(['./kumiko', '-i', folder, '--no-cache'], capture_output = True)
+			out += json.loads(res.stdout)
+			res = subprocess.run(['./kumiko', '-i', folder, '--no-cache'] + half, capture_output = True)
+			out_half += json.loads(res.stdout)
+
+		self.assertEqual(list(map(lambda p: p['filename'], out)), list(map(lambda p: p['filename'], out_half)))
+
+		# panels in original image coordinates, close to full resolution ones
+		# (gutterless splits may be found a few pixels apart)
+		ious = []
+		for page, page_half in zip(out, out_half):
+			self.assertEqual(page['size'], page_half['size'])
+			self.assertEqual(len(page['panels']), len(page_half['panels']))
+			width, height = page_half['size']
+			for xywh, xywh_half in zip(page['panels'], page_half['panels']):
+				x, y, w, h = xywh_half
+				self.assertTrue(x >= 0 and y >= 0 and x + w <= width and y + h <= height, msg = f"{xywh_half}")
+
+				panel, panel_half = Panel(page = None, xywh = xywh), Panel(page = None, xywh = xywh_half)
+				overlap = panel.overlap_area(panel_half)
+				ious.append(overlap / (panel.area() + panel_half.area() - overlap))
+
+		self.assertGreater(min(ious), 0.7)
+		self.assertGreater(sum(ious) / len(ious), 0.9)
+
+	def test_reduced_jpeg_decode(self):
+		filename = './tests/images/005-panels-without-frame/xkcd2434.jpg'
+		file_bytes = np.fromfile(filename, dtype = np.uint8)
+		full_gray = cv.imdecode(file_bytes, cv.IMREAD_GRAYSCALE)
+		size = [full_gray.shape[1], full_gray.shape[0]]
+		self.assertEqual(Page.jpeg_size(file_bytes), size)
+
+		# detection at 1/8th of the size: decoded at 1/4th, and downscaled to average pixels
+		gray, gray_size = Page.read_gray(file_bytes, detection_size = size[0] // 8)
+		self.assertEqual(gray_size, size)
+		self.assertEqual(list(gray.shape), [-(-size[1] // 4), -(-size[0] // 4)])
+
+		page = Page(filename, numbering = 'ltr', detection_size = size[0] // 8)
+		self.assertEqual(page.img_size, size)
+		self.assertEqual(page.detection_scale, 1 / 8)
+		self.assertEqual(list(page.gray.shape), [round(size[1] / 8), size[0] // 8])
+
+		# panels in original image coordinates, across the whole page
+		panels = page.get_infos()['panels']
+		self.assertGreater(len(panels), 0)
+		for x, y, w, h in panels:
+			self.assertTrue(x >= 0 and y >= 0 and x + w <= size[0] and y + h <= size[1])
+		self.assertGreater(max(map(lambda p: p[0] + p[2], panels)), size[0] * 0.95)
+		self.assertGreater(max(map(lambda p: p[1] + p[3], panels)), size[1] * 0.95)
+
+	def test_png_decode(self):
+		filename = './tests/images/005-panels-without-frame/xkcd217.png'
+		file_bytes = np.fromfile(filename, dtype = np.uint8)
+		self.assertIsNone(Page.jpeg_size(file_bytes))
+
+		# no reduced decoding for PNG files
+		gray, size = Page.read_gray(file_bytes, detection_size = 100)
+		self.assertEqual(list(gray.shape), [size[1], size[0]])
+		self.assertEqual(size, [700, 264])
+
+		page = Page(filename, numbering = 'ltr', detection_scale = 0.5)
+		self.assertEqual(page.img_size, size)
+		self.assertPanelsEqual(page.get_infos()['panels'], Page(filename, numbering = 'ltr').get_infos()['panels'])
+
+	def test_stream_run(self):
+		folder = './tests/images/005-panels-without-frame'
+		res = subprocess.run(['./kumiko', '-i', folder, '--no-cache'], capture_output = True)
+		res_stream = subprocess.run(['./kumiko', '-i', folder, '--no-cache', '--stream'], capture_output = True)
+
+		out = json.loads(res.stdout)
+		out_stream = json.loads(res_stream.stdout)
+
+		for page, page_stream in zip(out, out_stream):
+			page.pop('processing_time')
+			page_stream.pop('processing_time')
+		self.assertEqual(out, out_stream)
+		self.assertRegex(res_stream.stderr.decode("utf-8"), r'Peak memory: [\d.]+ MB')
+
+	def test_ndjson_run(self):
+		folder = './tests/images/005-panels-without-frame'
+		res = subprocess.run(['./kumiko', '-i', folder, '--no-cache'], capture_output = True)
+		res_ndjson = subprocess.run(
+			['./kumiko', '-i', folder, '--no-cache', '--format', 'ndjson'], capture_output = True
+		)
+
+		out = json.loads(res.stdout)
+		out_ndjson = list(map(json.loads, res_ndjson.stdout.decode("utf-8").splitlines()))
+
+		self.assertEqual(list(map(lambda p: p['filename'], out)), list(map(lambda p: p['filename'], out_ndjson)))
+		for page, page_ndjson in zip(out, out_ndjson):
+			self.assertPanelsEqual(page['panels'], page_ndjson['panels'])
+
+	def test_archive_run(self):
+		folder = './tests/images/005-panels-without-frame'
+		res = subprocess.run(['./kumiko', '-i', folder, '--no-cache'], capture_output = True)
+
+		# one folder per chapter, with the same file names
+		archive = os.path.join(BaseTest.results_dir(), 'book.cbz')
+		with zipfile.ZipFile(archive, 'w') as zf:
+			for chapter in ['ch2', 'ch1']:
+				for filename in os.listdir(folder):
+					zf.write(os.path.join(folder, filename), os.path.join(chapter, filename))
+
+		out = json.loads(res.stdout)
+		panels = dict(map(lambda p: (p['filename'], p['panels']), out))
+		nb_panels = sum(map(len, panels.values()))
+
+		for options in [[], ['--jobs', '2']]:
+			output_dir = BaseTest.results_dir()
+			res_archive = subprocess.run(
+				['./kumiko', '-i', archive, '--no-cache', '--save-panels', output_dir] + options, capture_output = True
+			)
+			out_archive = json.loads(res_archive.stdout)
+
+			# natural order: xkcd217 before xkcd1526, pages named by their path in the archive
+			filenames = ['xkcd217.png', 'xkcd1526.png', 'xkcd2434.jpg', 'xkcd2443.jpg', 'xkcd2444.jpg', 'xkcd2446.jpg']
+			self.assertEqual(
+				list(map(lambda p: p['filename'], out_archive)),
+				list(map(lambda f: 'ch1/' + f, filenames)) + list(map(lambda f: 'ch2/' + f, filenames))
+			)
+			for page in out_archive:
+				self.assertPanelsEqual(page['panels'], panels[os.path.basename(page['filename'])])
+
+			# each chapter's panels in its own folder
+			for chapter in ['ch1', 'ch2']:
+				chapter_dir = os.path.join(output_dir, chapter)
+				self.assertEqual(sorted(os.listdir(chapter_dir)), sorted(filenames))
+				nb_saved_panels = sum(map(lambda f: len(os.listdir(os.path.join(chapter_dir, f))), filenames))
+				self.assertEqual(nb_saved_panels, nb_panels)
+
+		html_file = os.path.join(BaseTest.results_dir(), 'book.html')
+		subprocess.run(['./kumiko', '-i', archive, '--no-cache', '--html', '-o', html_file], capture_output = True)
+		self.assertReaderImages(html_file)
+
+	def test_pdf_run(self):
+		import pymupdf
+
+		# one page that is a JPEG image, read as is, and one that is rendered
+		jpeg_image = './tests/images/005-panels-without-frame/xkcd2434.jpg'
+		pdf_file = os.path.join(BaseTest.results_dir(), 'book.pdf')
+		with pymupdf.open() as pdf:
+			for image in [jpeg_image, self.simple_image]:
+				pixmap = pymupdf.Pixmap(image)
+				page = pdf.new_page(width = pixmap.w * 72 / 150, height = pixmap.h * 72 / 150)
+				page.insert_image(page.rect, filename = image)
+			pdf.save(pdf_file)
+
+		res = subprocess.run(['./kumiko', '-i', jpeg_image, '--no-cache'], capture_output = True)
+		res_pdf = subprocess.run(['./kumiko', '-i', pdf_file, '--no-cache'], capture_output = True)
+
+		out = json.loads(res.stdout)
+		out_pdf = json.loads(res_pdf.stdout)
+
+		self.assertIn('PDF pages: 1 embedded images, 1 rendered', res_pdf.stderr.decode("utf-8"))
+		self.assertPanelsEqual(out_pdf[0]['panels'], out[0]['panels'])
+		self.assertPanelsEqual(out_pdf[1]['panels'], self.simple_image_panels)
+
+		html_file = os.path.join(BaseTest.results_dir(), 'book.html')
+		subprocess.run(['./kumiko', '-i', pdf_file, '--no-cache', '--html', '-o', html_file], capture_output = True)
+		self.assertReaderImages(html_file)
+
+	# HTML reader's page images exist, with the size given in pages' infos
+	def assertReaderImages(self, html_file):
+		with open(html_file) as fh:
+			html = fh.read()
+		images_dir = json.loads(re.search(r'images_dir: (".*"),', html).group(1))
+		infos = json.loads(re.search(r'comicsJson: (\[.*\]),', html).group(1))
+
+		for page in infos:
+			img = cv.imread(os.path.join(images_dir, page['filename']))
+			self.assertIsNotNone(img, msg = f"No image for page {page['filename']}")
+			self.assertEqual([img.shape[1], img.shape[0]], page['size'])
+
+	# Fixture server of given folder's images, each one served after `delay` seconds
+	@staticmethod
+	def image_server(folder, delay = 0):
+
+		class Handler(SimpleHTTPRequestHandler):
+
+			def do_GET(self):
+				time.sleep(delay)
+				super().do_GET()
+
+			def log_message(self, *args):
+				pass
+
+		server = ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(Handler, directory = folder))
+		threading.Thread(target = server.serve_forever, daemon = True).start()
+		return server, f"http://127.0.0.1:{server.server_address[1]}/"
+
+	def test_url_list_run(self):
+		folder = './tests/images/005-panels-without-frame'
+		server, base_url = TestKumiko.image_server(folder)
+		urls = list(map(lambda f: base_url + f, ['xkcd217.png', 'missing.png', 'xkcd2434.jpg']))
+		try:
+			res = subprocess.run(['./kumiko', '--no-cache', '-i'] + urls, capture_output = True)
+		finally:
+			server.shutdown()
+		out = json.loads(res.stdout)
+
+		# missing file is skipped
+		self.assertEqual(list(map(lambda p: p['filename'], out)), [urls[0], urls[2]])
+		for page in out:
+			filename = os.path.join(folder, os.path.basename(page['filename']))
+			res_file = subprocess.run(['./kumiko', '-i', filename, '--no-cache'], capture_output = True)
+			self.assertPanelsEqual(page['panels'], json.loads(res_file.stdout)[0]['panels'])
+
+	# Kumiko server process, listening on a free port, once its workers are warmed up
+	@staticmethod
+	def kumiko_server(options):
+		with socket.socket() as s:
+			s.bind(('127.0.0.1', 0))
+			port = s.getsockname()[1]
+		process = subprocess.Popen(
+			['./server.py', '--port', str(port)] + options, stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL
+		)
+
+		for _ in range(100):
+			try:
+				urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics").close()
+				break
+			except urllib.error.URLError:
+				time.sleep(0.1)
+
+		return process, f"http://127.0.0.1:{port}"
+
+	# Stop Kumiko server process, which stops its worker processes too
+	def stop_kumiko_server(self, process):
+		res = subprocess.run(['pgrep', '-P', str(process.pid)], capture_output = True)
+		workers = list(map(int, res.stdout.split()))
+		self.assertGreater(len(workers), 0)
+
+		process.terminate()
+		process.wait()
+
+		for pid in workers:
+			with self.assertRaises(ProcessLookupError, msg = f"Worker process {pid} is still running"):
+				os.kill(pid, 0)
+
+	# HTTP status and body of response to given request
+	@staticmethod
+	def http_request(url, data = None, headers = None):
+		try:
+			with urllib.request.urlopen(urllib.request.Request(url, data = data, headers = headers or {})) as r:
+				return r.status, r.read().decode('utf-8')
+		except urllib.error.HTTPError as e:
+			return e.code, None
+
+	def test_server(self):
+		server, base_url = TestKumiko.image_server('./tests/images/000-common-page-templates', delay = 1)
+		kumiko_server, kumiko_url = TestKumiko.kumiko_server(['--workers', '1', '--queue-size', '0'])
+		page_url = kumiko_url + '/html?url=' + base_url + 'simple.png'
+
+		try:
+			# only worker is busy with first request, and no request may wait for it
+			results = []
+			first = threading.Thread(target = lambda: results.append(TestKumiko.http_request(page_url)))
+			first.start()
+			time.sleep(0.5)
+			self.assertEqual(TestKumiko.http_request(page_url)[0], 429)
+			first.join()
+
+			status, html = results[0]
+			self.assertEqual(status, 200)
+			infos = json.loads(re.search(r'comicsJson: (\[.*\]),', html).group(1))
+			self.assertPanelsEqual(infos[0]['panels'], self.simple_image_panels)
+
+			metrics = json.loads(TestKumiko.http_request(kumiko_url + '/metrics')[1])
+			self.assertEqual(metrics['tasks'], {'interactive': {'ok': 1, 'rejected': 1}, 'background': {}})
+			self.assertEqual(metrics['queue_depth'], 0)
+		finally:
+			self.stop_kumiko_server(kumiko_server)
+			server.shutdown()
+
+	def test_server_jobs(self):
+		folder = './tests/images/005-panels-without-frame'
+		server, base_url = TestKumiko.image_server(folder, delay = 0.5)
+		options = ['--workers', '2', '--queue-size', '0', '--job-workers', '1']
+		kumiko_server, kumiko_url = TestKumiko.kumiko_server(options)
+		urls = list(map(lambda f: base_url + f, ['xkcd217.png', 'missing.png', 'xkcd2434.jpg', 'xkcd2443.jpg']))
+
+		try:
+			status, body = TestKumiko.http_request(
+				kumiko_url + '/jobs',
+				data = json.dumps({'urls': urls}).encode(),
+				headers = {'Content-Type': 'application/json'}
+			)
+			self.assertEqual(status, 202)
+			job = json.loads(body)
+
+			# job takes one worker at most, the other one is left to interactive requests
+			time.sleep(0.2)
+			self.assertEqual(TestKumiko.http_request(kumiko_url + '/html?url=' + urls[0])[0], 200)
+
+			# streamed until job is done, missing file is skipped
+			pages = list(map(json.loads, TestKumiko.http_request(kumiko_url + job['pages_url'])[1].splitlines()))
+			self.assertEqual(list(map(lambda p: p['filename'], pages)), [urls[0], urls[2], urls[3]])
+
+			status = json.loads(TestKumiko.http_request(kumiko_url + job['status_url'])[1])
+			self.assertEqual(status['status'], 'done')
+			self.assertEqual(status['nb_done'], len(urls))
+			self.assertIn('error', status['pages'][1])
+			self.assertEqual(status['pages'][0], pages[0])
+
+			# uploaded comic book archive, pages named by their path in the archive
+			archive = os.path.join(BaseTest.results_dir(), 'book.cbz')
+			with zipfile.ZipFile(archive, 'w') as zf:
+				for chapter in ['ch1', 'ch2']:
+					for filename in os.listdir(folder):
+						zf.write(os.path.join(folder, filename), os.path.join(chapter, filename))
+
+			boundary = 'kumiko-test-boundary'
+			with open(archive, 'rb') as fh:
+				data = b'\r\n'.join([
+					f"--{boundary}".encode(),
+					b'Content-Disposition: form-data; name="file"; filename="book.cbz"',
+					b'Content-Type: application/zip',
+					b'',
+					fh.read(),
+					f"--{boundary}--".encode(),
+					b'',
+				])
+			headers = {'Content-Type': f"multipart/form-data; boundary={boundary}"}
+			status, body = TestKumiko.http_request(kumiko_url + '/jobs', data = data, headers = headers)
+			self.assertEqual(status, 202)
+			job = json.loads(body)
+			pages = list(map(json.loads, TestKumiko.http_request(kumiko_url + job['pages_url'])[1].splitlines()))
+
+			res = subprocess.run(['./kumiko', '-i', folder, '--no-cache'], capture_output = True)
+			nb_panels = dict(map(lambda p: (p['filename'].split('/')[-1], len(p['panels'])), json.loads(res.stdout)))
+			filenames = ['xkcd217.png', 'xkcd1526.png', 'xkcd2434.jpg', 'xkcd2443.jpg', 'xkcd2444.jpg', 'xkcd2446.jpg']
+			self.assertEqual(
+				list(map(lambda p: p['filename'], pages)),
+				list(map(lambda f: 'ch1/' + f, filenames)) + list(map(lambda f: 'ch2/' + f, filenames))
+			)
+			for page in pages:
+				self.assertEqual(len(page['panels']), nb_panels[os.path.basename(page['filename'])])
+
+			# jobs' pages are counted apart from /html requests (once done callbacks have run, just after results)
+			for _ in range(10):
+				metrics = json.loads(TestKumiko.http_request(kumiko_url + '/metrics')[1])
+				if sum(metrics['tasks']['background'].values()) == 16:
+					break
+				time.sleep(0.1)
+			self.assertEqual(metrics['tasks'], {'interactive': {'ok': 1}, 'background': {'ok': 15, 'error': 1}})
+			self.assertIsNotNone(metrics['latency_seconds']['background']['p50'])
+		finally:
+			self.stop_kumiko_server(kumiko_server)
+			server.shutdown()
+
+	def test_cache(self):
+		cache_dir = BaseTest.results_dir()
+		for _ in range(2):  # second run reads results from cache
+			res = subprocess.run(['./kumiko', '-i', self.simple_image, '--cache-dir', cache_dir], capture_output = True)
+			out = json.loads(res.stdout)
+			self.assertPanelsEqual(out[0].get("panels", []), self.simple_image_panels)
+
+		nb_entries = sum(map(lambda e: len(e[2]), os.walk(cache_dir)))
+		self.assertEqual(nb_entries, 1)
+
+	def test_cache_eviction(self):
+		infos = {'panels': [[0, 0, 100, 100]]}
+		entry_size = len(json.dumps(infos))
+		cache = Cache(BaseTest.results_dir(), max_size = 4.5 * entry_size)
+
+		keys = list(map(lambda i: Cache.key(str(i).encode(), {}, 1), range(5)))
+		for i, key in enumerate(keys[:4]):
+			cache.set(key, infos)
+			os.utime(cache.path(key), (i, i))  # entries used in order, long ago
+		cache.get(keys[0])  # first entry is used again
+
+		# fifth entry goes over max size: least recently used entry is evicted, down to 90% of max size
+		cache.set(keys[4], infos)
+		self.assertIsNone(cache.get(keys[1]))
+		for key in [keys[0], keys[2], keys[3], keys[4]]:
+			self.assertEqual(cache.get(key), infos)
+		self.assertEqual(cache.size, 4 * entry_size)
+
+		# overwritten entries are only counted once
+		cache = Cache(BaseTest.results_dir(), max_size = 10 * entry_size)
+		for _ in range(3):
+			cache.set(keys[0], infos)
+		self.assertEqual(cache.size, entry_size)
+
 	def test_panels_saving(self):
 		res = subprocess.run(
-			['./kumiko', '-i', self.simple_image, '--save-panels',
+			['./kumiko', '-i', self.simple_image, '--no-cache', '--save-panels',
 				BaseTest.results_dir()], capture_output = True
 		)
 
@@ -40,6 +454,14 @@ class TestKumiko(BaseTest):
 		out_dir = os.path.join(match[1], 'simple.png')
 		self.assertEqual(len(os.listdir(out_dir)), len(self.simple_image_panels))
 
+	def test_panels_saving_format(self):
+		output_dir = BaseTest.results_dir()
+		options = ['--save-panels', output_dir, '--panels-format', 'webp', '--panels-quality', '50']
+		subprocess.run(['./kumiko', '-i', self.simple_image, '--no-cache'] + options, capture_output = True)
+
+		files = sorted(os.listdir(os.path.join(output_dir, 'simple.png')))
+		self.assertEqual(files, [f"panel_{i}.webp" for i in range(len(self.simple_image_panels))])
+
 
 if __name__ == '__main__':
 	BaseTest.run_all()